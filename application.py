@@ -1,19 +1,209 @@
-from data_visualization import render_dashboard
-from flask import Flask
-import codecs	
+from data_visualization import render_dashboard, get_tab_item, get_all_continent, get_max_date, RenderParams
+from dashboard_cache import RenderCache, DataWatcher
+from data_analysis import analysis_cache
+from data_preprocessing import DataPreprocessing, data_context
+from flask import Flask, Response, abort, g, jsonify, make_response, request
+import data_api
+import data_cache
+import instrumentation
+import metrics
+import os
+import time
 
 application = Flask(__name__)
 title = 'Corona Board'
+file_name = "template/dash_board.html"
+
+# Reload the dataset whenever data/*.xlsx changed
+render_cache = RenderCache(on_new_version=data_context.invalidate)
+
+# The /api responses, kept apart so that they never evict the dashboard and its tabs.
+# At most CORONA_BOARD_API_CACHE_SIZE of them are kept, the least recently used are dropped first
+api_cache_size = int(os.environ.get('CORONA_BOARD_API_CACHE_SIZE', '256'))
+api_cache = RenderCache(max_items=api_cache_size, parent=render_cache)
+
+# Seconds between two checks of data/ by the background watcher,
+# 0 checks the files and reloads them on the request path instead
+watch_interval = float(os.environ.get('CORONA_BOARD_WATCH_INTERVAL', '5'))
+
+# CORONA_BOARD_TRACE_MEMORY=1 adds the peak memory of every stage to the Server-Timing header,
+# CORONA_BOARD_PROFILE_DIR=<dir> dumps a cProfile of every request there
+trace_memory = os.environ.get('CORONA_BOARD_TRACE_MEMORY') == '1'
+profile_dir = os.environ.get('CORONA_BOARD_PROFILE_DIR')
+
+def get_cache_stats(stat):
+	return lambda: [({'cache': 'render'}, getattr(render_cache, stat)),
+					({'cache': 'api'}, getattr(api_cache, stat)),
+					({'cache': 'analysis'}, analysis_cache.get_stats()[stat]),
+					({'cache': 'workbook'}, data_cache.stats[stat])]
+
+metrics.registry.register(metrics.CallbackMetric(
+	'corona_board_cache_hits', 'Lookups answered by a cache', 'counter', get_cache_stats('hits')))
+metrics.registry.register(metrics.CallbackMetric(
+	'corona_board_cache_misses', 'Lookups a cache had to build', 'counter', get_cache_stats('misses')))
+metrics.registry.register(metrics.CallbackMetric(
+	'corona_board_preprocessing', 'Reports parsed, expanded or loaded from the snapshot instead', 'counter',
+	lambda: [({'step': step}, count) for step, count in DataPreprocessing.stats.items()]))
+
+def measured(output, build):
+	""" build() that records the size of what it built """
+	def build_measured():
+		body = build()
+		metrics.output_bytes.observe(len(body.encode('utf-8')), output=output)
+		return body
+	return build_measured
+
+def build_dashboard():
+	# The page is kept in memory, the file is only written for the static copy
+	return render_dashboard(file_name = file_name)
+
+def get_prebuilt_items():
+	""" key -> build of the outputs rendered before a data version is served """
+	builds = {'dashboard': measured('dashboard', build_dashboard)}
+	if RenderParams.lazy_tabs:
+		for continent in get_all_continent(get_max_date()):
+			builds[('tab', 'continent', continent)] = measured('tab', lambda c=continent: get_tab_item('continent', c))
+	return builds
+
+def rebuild(version):
+	""" Load and render a new data version off the request path, then serve it in one step.
+		Until then the requests keep getting the previous version """
+	data_process, data_fltr = data_context.load()
+	with data_context.using(data_process, data_fltr):
+		bodies = {key: build() for key, build in get_prebuilt_items().items()}
+	data_context.set(data_process, data_fltr)
+	render_cache.publish(version, bodies)
+
+data_watcher = DataWatcher(rebuild, interval=watch_interval)
+
+metrics.registry.register(metrics.CallbackMetric(
+	'corona_board_data_rebuilds', 'Data versions built by the watcher, by result', 'counter',
+	lambda: [({'result': 'ok'}, data_watcher.stats['rebuilds']),
+			 ({'result': 'failed'}, data_watcher.stats['failures'])]))
+
+@application.before_first_request
+def start_watcher():
+	# The first request waits for the first build, the later ones never wait for a render
+	if watch_interval > 0:
+		data_watcher.start()
+
+def cached_response(item, mimetype = 'text/html'):
+	""" Response of a cached item with its ETag, gzip compressed when the client accepts it """
+	if 'gzip' in request.headers.get('Accept-Encoding', ''):
+		response = make_response(item.get_gzip_body())
+		response.headers['Content-Encoding'] = 'gzip'
+		response.set_etag(item.etag + '-gzip')
+	else:
+		response = make_response(item.body)
+		response.set_etag(item.etag)
+
+	response.mimetype = mimetype
+	response.vary.add('Accept-Encoding')
+	# Let the client keep its copy but revalidate it with If-None-Match
+	response.cache_control.no_cache = True
+
+	return response.make_conditional(request)
+
+@application.before_request
+def start_timing():
+	g.request_start = time.perf_counter()
+	g.collector = instrumentation.begin('request', trace_memory)
+	if profile_dir:
+		g.profiler = instrumentation.Profiler(profile_dir, request.path)
+		g.profiler.start()
+
+@application.after_request
+def add_server_timing(response):
+	""" Time of every stage the request went through, e.g. the data load and the tab layouts
+		of the render that a cache miss triggered """
+	collector = g.pop('collector', None)
+	if collector is not None:
+		instrumentation.end(collector)
+		elapsed = time.perf_counter() - g.request_start
+		total = 'total;dur={:.1f}'.format(elapsed * 1000)
+		response.headers['Server-Timing'] = ', '.join(filter(None, [collector.get_server_timing(), total]))
+		observe_request(elapsed, response.status_code)
+	return response
+
+def observe_request(elapsed, status):
+	# The route rule, not the path, so unknown paths do not each get their own series
+	route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+	metrics.request_seconds.observe(elapsed, route=route, method=request.method, status=status)
+
+@application.teardown_request
+def stop_timing(error=None):
+	# after_request is skipped when the view raised
+	collector = g.pop('collector', None)
+	if collector is not None:
+		instrumentation.end(collector)
+		observe_request(time.perf_counter() - g.request_start, 500)
+	profiler = g.pop('profiler', None)
+	if profiler is not None:
+		profiler.stop()
 
 @application.route('/')
 def bokeh():
-	file_name = "template/dash_board.html"
-	render_dashboard(file_name = file_name)
-	f = codecs.open(file_name, 'r')
-	layout = f.read()
-	
-	return 	layout
+	dashboard = render_cache.get('dashboard', measured('dashboard', build_dashboard))
+
+	return cached_response(dashboard)
+
+def json_error(status, message):
+	""" Error response the page's fetch can read, {"error": message} """
+	response = jsonify(error=message)
+	response.status_code = status
+	return response
+
+@application.route('/tab')
+def tab():
+	""" One dashboard tab as a Bokeh JSON item, fetched by the page when the tab is opened """
+	level = request.args.get('level')
+	location = request.args.get('location')
+
+	try:
+		item = render_cache.get(('tab', level, location), measured('tab', lambda: get_tab_item(level, location)))
+	except KeyError:
+		return json_error(404, f'unknown location: {level}/{location}')
+	except Exception:
+		application.logger.exception('rendering the tab %s/%s failed', level, location)
+		return json_error(500, 'the tab could not be rendered')
+
+	return cached_response(item, 'application/json')
+
+def api_response(build, *params):
+	""" JSON response of build(*request arguments), cached per set of parsed arguments """
+	try:
+		# A new data version is loaded before the defaults are taken from it
+		api_cache.get_version()
+		args = list(data_api.parse_params((param, request.args.get(param)) for param in params).values())
+		key = (request.path,) + tuple(args)
+		item = api_cache.get(key, measured('api', lambda: data_api.dumps(build(*args))))
+	except ValueError as e:
+		abort(400, str(e))
+	except KeyError:
+		abort(404)
+
+	return cached_response(item, 'application/json')
+
+@application.route('/api/summary')
+def api_summary():
+	return api_response(data_api.get_summary, 'to')
+
+@application.route('/api/location-summary')
+def api_location_summary():
+	return api_response(data_api.get_location_summary, 'level', 'location', 'to')
+
+@application.route('/api/visualization')
+def api_visualization():
+	return api_response(data_api.get_visualization_data, 'level', 'location', 'to')
+
+@application.route('/api/time-series')
+def api_time_series():
+	return api_response(data_api.get_time_series, 'kind', 'rate', 'level', 'location', 'from', 'to')
 
+@application.route('/metrics')
+def prometheus_metrics():
+	""" Request, render, data load and cache statistics of this process for Prometheus to scrape """
+	return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
 
 if __name__ == '__main__':
 	application.run(debug=True)
@@ -0,0 +1,598 @@
+""" Benchmarks of the data pipeline.
+
+Run all of them with `python benchmarks.py` or pick some by name,
+e.g. `python benchmarks.py expand_data_df stages`. Add `--output results.json`
+to save the results, so runs can be compared.
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from bokeh.embed import json_item
+
+from data_preprocessing import DataPreprocessing, DataFiltering, AggregateCube, data_context
+from data_analysis import to_mercator, analysis_cache, AnalysisFacad, LocationProfileAnalysisFacad, \
+    DataLocationLevelAnalysis, DataTimeAnalysis
+from data_visualization import get_world_wide_layout, get_location_profile_layout, get_page_html, BarParams, \
+    LineGraphParams, Utilities
+import data_metrics
+import synthetic_data
+
+
+def best_time(func, repeat=3):
+    """ Best wall-clock time of func() in seconds and its last result """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def load_report(dataset_file_name='data/corona_report.xlsx'):
+    """ The raw report with parsed dates, i.e. the input of expand_data_df """
+    data_df = pd.read_excel(dataset_file_name)
+    data_df.date = pd.to_datetime(data_df.date)
+    return data_df
+
+
+def scale_dates(data_df, factor):
+    """ Repeat the report factor times, shifting every copy after the previous one """
+    span = data_df.date.max() - data_df.date.min() + pd.Timedelta(days=1)
+    copies = []
+    for k in range(factor):
+        df = data_df.copy()
+        df.date = df.date + k * span
+        copies.append(df)
+    return pd.concat(copies, ignore_index=True)
+
+
+def print_table(header, rows):
+    """ Print the rows and return them as records """
+    print(' | '.join(header))
+    for r in rows:
+        print(' | '.join(str(v) for v in r))
+    print()
+    return [dict(zip(header, r)) for r in rows]
+
+
+def bench_expand_data_df(factors=(1, 10, 100)):
+    """ Day by day loop against the vectorized MultiIndex reindex """
+    report_df = load_report()
+    rows = []
+    for factor in factors:
+        data_df = scale_dates(report_df, factor)
+        repeat = 1 if factor >= 100 else 3
+
+        per_day_time, expected = best_time(lambda: DataPreprocessing.expand_per_day(data_df), repeat)
+        vectorized_time, result = best_time(lambda: DataPreprocessing.expand_vectorized(data_df), repeat)
+        pd.testing.assert_frame_equal(result, expected)
+
+        rows.append([f'{factor}x', data_df.date.nunique(), len(result),
+                     '%.4f' % per_day_time, '%.4f' % vectorized_time,
+                     '%.1fx' % (per_day_time / vectorized_time)])
+
+    return print_table(['scale', 'days', 'rows', 'per day (s)', 'vectorized (s)', 'speedup'], rows)
+
+
+def make_expanded_frame(num_rows, num_countries=200):
+    """ An expanded data_df like frame of about num_rows rows, sorted by date then country """
+    num_days = max(1, num_rows // num_countries)
+    countries = [f'country_{i:03d}' for i in range(num_countries)]
+    dates = pd.date_range('2020-01-21', periods=num_days)
+
+    index = pd.MultiIndex.from_product([dates, countries], names=['date', 'country'])
+    df = index.to_frame(index=False)
+    country_ids = np.tile(np.arange(num_countries), num_days)
+    df['region'] = ['region_%d' % (i % 6) for i in country_ids]
+    df['continent'] = ['continent_%d' % (i % 5) for i in country_ids]
+    df['total_cases'] = np.random.RandomState(0).randint(0, 1000, len(df)).astype(float)
+    return df[['country', 'date', 'total_cases', 'region', 'continent']]
+
+
+class MaskFiltering:
+    """ The boolean mask filters DataFiltering used before its indexes """
+    def __init__(self, data_df):
+        self.data_df = data_df
+
+    def get_specific_date_stats(self, date):
+        return self.data_df[self.data_df.date == pd.Timestamp(date)]
+
+    def get_until_specific_date_stats(self, date):
+        return self.data_df[self.data_df.date <= pd.Timestamp(date)]
+
+    def get_specific_location_stats(self, loc_column, loc_value):
+        return self.data_df[self.data_df[loc_column] == loc_value]
+
+    def get_specific_date_location_stats(self, date, loc_column, loc_value):
+        return self.data_df[(self.data_df[loc_column] == loc_value) &
+                            (self.data_df.date == pd.Timestamp(date))]
+
+    def get_until_date_location_stats(self, date, loc_column, loc_value):
+        return self.data_df[(self.data_df[loc_column] == loc_value) &
+                            (self.data_df.date <= pd.Timestamp(date))]
+
+
+def bench_data_filtering(sizes=(10000, 100000, 1000000), calls=20):
+    """ Boolean mask scans against the date and location indexes of DataFiltering """
+    rows = []
+    for size in sizes:
+        data_df = make_expanded_frame(size)
+        middle_date = data_df.date.iloc[len(data_df) // 2]
+
+        index_build_time, indexed = best_time(lambda: DataFiltering(data_df, None, None, None), 1)
+        masked = MaskFiltering(data_df)
+
+        queries = {
+            'specific_date': ('get_specific_date_stats', (middle_date,)),
+            'until_date': ('get_until_specific_date_stats', (middle_date,)),
+            'location': ('get_specific_location_stats', ('continent', 'continent_1')),
+            'date_location': ('get_specific_date_location_stats', (middle_date, 'region', 'region_2')),
+            'until_date_location': ('get_until_date_location_stats', (middle_date, 'country', 'country_007')),
+        }
+        for query, (method, args) in queries.items():
+            mask_time, expected = best_time(
+                lambda: [getattr(masked, method)(*args) for _ in range(calls)][-1])
+            index_time, result = best_time(
+                lambda: [getattr(indexed, method)(*args) for _ in range(calls)][-1])
+            pd.testing.assert_frame_equal(result, expected)
+
+            rows.append([len(data_df), query, '%.4f' % (mask_time / calls), '%.4f' % (index_time / calls),
+                         '%.1fx' % (mask_time / index_time)])
+        rows.append([len(data_df), 'index build', '', '%.4f' % index_build_time, ''])
+
+    return print_table(['rows', 'query', 'mask (s/call)', 'indexed (s/call)', 'speedup'], rows)
+
+
+def project_per_point(long, lat):
+    """ The per-row pyproj.transform loop add_mercator_coordinates used before """
+    from pyproj import Proj, transform
+    in_wgs = Proj(init='epsg:4326')
+    out_mercator = Proj(init='epsg:3857')
+    x, y = np.empty(len(long)), np.empty(len(long))
+    for i in range(len(long)):
+        x[i], y[i] = transform(in_wgs, out_mercator, long[i], lat[i])
+    return x, y
+
+
+def bench_mercator_projection(sizes=(10000, 1000000), loop_max_size=10000):
+    """ Per point pyproj.transform against the cached vectorized transformer.
+        The loop is only timed up to loop_max_size points, it takes minutes for 1M """
+    rows = []
+    random_state = np.random.RandomState(0)
+    for size in sizes:
+        long = random_state.uniform(-180, 180, size)
+        lat = random_state.uniform(-85, 85, size)
+
+        vectorized_time, (x, y) = best_time(lambda: to_mercator(long, lat))
+        if size <= loop_max_size:
+            loop_time, (expected_x, expected_y) = best_time(lambda: project_per_point(long, lat), 1)
+            np.testing.assert_allclose(x, expected_x)
+            np.testing.assert_allclose(y, expected_y)
+            rows.append([size, '%.4f' % loop_time, '%.4f' % vectorized_time, '%.1fx' % (loop_time / vectorized_time)])
+        else:
+            rows.append([size, 'skipped', '%.4f' % vectorized_time, ''])
+
+    return print_table(['points', 'per point (s)', 'vectorized (s)', 'speedup'], rows)
+
+
+def to_plain_frame(df):
+    """ df with its index as columns and categoricals as objects, to compare the values only """
+    df = df.reset_index()
+    return df.astype({col: object for col, dtype in df.dtypes.items() if dtype.name == 'category'})
+
+
+def check_same_cube(result, expected, check_dtype=True):
+    def check(result_df, expected_df):
+        pd.testing.assert_frame_equal(to_plain_frame(result_df), to_plain_frame(expected_df),
+                                      check_dtype=check_dtype)
+
+    check(result.global_sums, expected.global_sums)
+    pd.testing.assert_frame_equal(result.infected, expected.infected)
+    for level in AggregateCube.levels:
+        check(result.level_sums[level], expected.level_sums[level])
+        check(result.first_dates[level], expected.first_dates[level])
+        pd.testing.assert_series_equal(result.country_location[level], expected.country_location[level],
+                                       check_names=False)
+        assert result.level_countries[level] == expected.level_countries[level]
+
+
+def bench_append_data(new_days=(1, 7), new_country='Newland', scales=(None, (400, 720))):
+    """ Full rebuild against DataPreprocessing.append_data of the last days of the report,
+        data/ (None) and generated datasets of (countries, days).
+        The second run also renames a country of the new days to check new countries """
+    rows = []
+    for scale in scales:
+        if scale is None:
+            data_process = DataPreprocessing(use_snapshot=False)
+            full_df = load_report()
+        else:
+            dataset = synthetic_data.generate_dataset(num_countries=scale[0], num_days=scale[1])
+            data_process = DataPreprocessing.from_frames(dataset['report'], dataset['locations'],
+                                                         dataset['risk_assessment'], dataset['testing_laboratories'])
+            full_df = dataset['report']
+        bench_append_scale(data_process, full_df, new_days, new_country, rows)
+
+    return print_table(['new days', 'new country', 'rows', 'rebuild (s)', 'append (s)', 'speedup'], rows)
+
+
+def bench_append_scale(data_process, full_df, new_days, new_country, rows):
+    for days in new_days:
+        for rename in (False, True):
+            report_df = full_df.copy()
+            split_date = report_df.date.max() - pd.Timedelta(days=days - 1)
+            if rename:
+                renamed = (report_df.date >= split_date) & (report_df.country == report_df.country.iloc[-1])
+                report_df.loc[renamed, 'country'] = new_country
+            history_df, delta_df = report_df[report_df.date < split_date], report_df[report_df.date >= split_date]
+
+            def rebuild(df):
+                data_process.data_df = data_process.merge_locations(DataPreprocessing.expand_vectorized(df))
+                data_fltr = DataFiltering(data_process.data_df, None, None, None)
+                data_fltr.get_location_positions('country', new_country)
+                data_fltr.get_aggregate_cube()
+                return data_fltr
+
+            rebuild_time, expected = best_time(lambda: rebuild(report_df))
+
+            def append():
+                shared = rebuild(history_df)
+                shared_sums = shared.get_aggregate_cube().global_sums
+                start = time.perf_counter()
+                data_fltr = shared.copy()
+                # data_df is only the new one once append_data returned
+                new_rows = data_process.append_data(delta_df)
+                data_fltr.append_data(data_process.data_df, new_rows)
+                elapsed = time.perf_counter() - start
+                # Appending to a copy leaves the data other threads read unchanged
+                assert shared.get_aggregate_cube().global_sums is shared_sums
+                assert len(shared.get_specific_location_stats('country', new_country)) == 0
+                assert shared.get_specific_date_stats(report_df.date.max()).empty
+                return elapsed, data_fltr
+
+            append_time, result = min((append() for _ in range(3)), key=lambda r: r[0])
+            pd.testing.assert_frame_equal(result.data_df, expected.data_df)
+            check_same_cube(result.get_aggregate_cube(), expected.get_aggregate_cube())
+            for date in (split_date - pd.Timedelta(days=1), split_date, report_df.date.max()):
+                pd.testing.assert_frame_equal(result.get_until_date_location_stats(date, 'country', new_country),
+                                              expected.get_until_date_location_stats(date, 'country', new_country))
+                pd.testing.assert_frame_equal(result.get_specific_date_stats(date),
+                                              expected.get_specific_date_stats(date))
+
+            rows.append([days, 'yes' if rename else 'no', len(expected.data_df),
+                         '%.4f' % rebuild_time, '%.4f' % append_time, '%.1fx' % (rebuild_time / append_time)])
+
+
+def loosen_dtypes(data_df):
+    """ data_df as it was before compact_data_df: object locations and float counts """
+    dtypes = {col: object for col in DataPreprocessing.location_columns}
+    dtypes.update({col: np.float64 for col in AggregateCube.metric_columns})
+    return data_df.astype(dtypes)
+
+
+def bench_compaction(calls=20):
+    """ Memory, index build, aggregation and filters of the compacted data_df against object/float64 columns """
+    data_process = DataPreprocessing(use_snapshot=False)
+    print(data_process.get_memory_report())
+    compact_df = data_process.data_df
+    loose_df = loosen_dtypes(compact_df)
+    middle_date = compact_df.date.iloc[len(compact_df) // 2]
+
+    def filtering(data_df):
+        data_fltr = DataFiltering(data_df, None, None, None)
+        for level in AggregateCube.levels:
+            data_fltr.get_location_positions(level, None)
+        return data_fltr
+
+    steps = {
+        'location index build': lambda df: filtering(df),
+        'aggregate cube build': lambda df: AggregateCube(df),
+        'region date sums': lambda df: df.groupby(['region', 'date'], observed=True)[
+            AggregateCube.metric_columns].sum(),
+    }
+    rows = []
+    for step, func in steps.items():
+        loose_time, _ = best_time(lambda: func(loose_df))
+        compact_time, _ = best_time(lambda: func(compact_df))
+        rows.append([step, '%.4f' % loose_time, '%.4f' % compact_time, '%.1fx' % (loose_time / compact_time)])
+
+    loose_fltr, compact_fltr = filtering(loose_df), filtering(compact_df)
+    check_same_cube(AggregateCube(compact_df), AggregateCube(loose_df), check_dtype=False)
+    for level, location in (('country', 'China'), ('continent', compact_df.continent.dropna().iloc[0])):
+        loose_time, expected = best_time(lambda: [loose_fltr.get_until_date_location_stats(
+            middle_date, level, location) for _ in range(calls)][-1])
+        compact_time, result = best_time(lambda: [compact_fltr.get_until_date_location_stats(
+            middle_date, level, location) for _ in range(calls)][-1])
+        pd.testing.assert_frame_equal(to_plain_frame(loosen_dtypes(result)), to_plain_frame(expected))
+        rows.append([f'{level} filter', '%.4f' % (loose_time / calls), '%.4f' % (compact_time / calls),
+                     '%.1fx' % (loose_time / compact_time)])
+
+    return print_table(['step', 'object/float64 (s)', 'compact (s)', 'speedup'], rows)
+
+
+def make_counts_frame(size):
+    """ Random cases, deaths and transmission counts with zeros, like a date of data_df """
+    random_state = np.random.RandomState(0)
+    total_cases = random_state.randint(0, 100000, size) * (random_state.rand(size) > 0.1)
+    return pd.DataFrame({
+        'total_cases': total_cases,
+        'total_deaths': (total_cases * random_state.rand(size) * 0.1).astype(np.int64),
+        'total_cases_with_transmission_outside_china': (total_cases * random_state.rand(size)).astype(np.int64)
+    })
+
+
+def percentage_per_row(numerator, denominator):
+    """ The .apply lambdas of the analysis before data_metrics """
+    ratio = numerator / denominator
+    ratio = ratio.apply(lambda x: (x * 100))
+    return ratio.apply(lambda x: round(x, 2))
+
+
+def cases_deaths_log_per_row(df):
+    total_cases_log = df.total_cases.apply(lambda x: np.log(x + 0.1) * 50 if x != 0 else 0)
+    df = df.assign(total_cases_log=total_cases_log)
+    return df.apply(lambda x: (x['total_cases_log'] * x['fatality_rate']) / 100, axis=1)
+
+
+def bench_metrics(sizes=(1000, 100000)):
+    """ Per row .apply lambdas against data_metrics, the results must be identical """
+    rows = []
+    for size in sizes:
+        df = make_counts_frame(size)
+        df['fatality_rate'] = data_metrics.get_percentage(df.total_deaths.values, df.total_cases.values)
+
+        metrics = {
+            'percentage': (lambda: percentage_per_row(df.total_deaths, df.total_cases).values,
+                           lambda: data_metrics.get_percentage(df.total_deaths.values, df.total_cases.values)),
+            'cases/deaths log': (lambda: cases_deaths_log_per_row(df).values,
+                                 lambda: data_metrics.log_scale(df.total_cases.values) * df.fatality_rate.values / 100),
+            'circle size': (lambda: df.total_cases.apply(lambda x: 0 if x == 0 else np.log10(x + 0.5) * 10).values,
+                            lambda: data_metrics.marker_size(df.total_cases.values)),
+        }
+        for metric, (per_row, vectorized) in metrics.items():
+            per_row_time, expected = best_time(per_row)
+            vectorized_time, result = best_time(vectorized)
+            np.testing.assert_array_equal(result, expected.astype(np.float64))
+            rows.append([size, metric, '%.4f' % per_row_time, '%.4f' % vectorized_time,
+                         '%.1fx' % (per_row_time / vectorized_time)])
+
+    return print_table(['rows', 'metric', 'per row (s)', 'vectorized (s)', 'speedup'], rows)
+
+
+def time_stages(dataset, file_format=None, repeat=3):
+    """ Seconds of every stage of the dashboard on one generated dataset """
+    times = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        file_names = synthetic_data.write_dataset(dataset, data_dir, file_format)
+        times['load'], frames = best_time(lambda: synthetic_data.read_dataset(file_names), repeat)
+
+    raw_df = frames['report']
+    raw_df.date = pd.to_datetime(raw_df.date)
+    times['expand'], expanded_df = best_time(lambda: DataPreprocessing.expand_vectorized(raw_df), repeat)
+
+    data_process = DataPreprocessing.from_frames(frames['report'], frames['locations'],
+                                                 frames['risk_assessment'], frames['testing_laboratories'])
+    times['merge'], _ = best_time(lambda: data_process.merge_locations(expanded_df), repeat)
+
+    data_df = data_process.data_df
+    _, to_date = data_process.get_start_and_end_date()
+    location = ('continent', data_df.continent.iloc[0])
+
+    def filtering():
+        data_fltr = DataFiltering(data_df, data_process.locations_df, data_process.risk_assessment_df,
+                                  data_process.testing_laboratories_df)
+        data_fltr.get_aggregate_cube()
+        for level in AggregateCube.levels:
+            data_fltr.get_specific_date_location_stats(to_date, level, data_df[level].iloc[0])
+        data_fltr.get_until_date_location_stats(to_date, *location)
+        return data_fltr
+
+    times['filter'], data_fltr = best_time(filtering, repeat)
+
+    def facades():
+        analysis_cache.clear()
+        time_analyser = DataTimeAnalysis(data_process, data_fltr, to_date=to_date)
+        lc = DataLocationLevelAnalysis(data_process, data_fltr, to_date=to_date)
+        AnalysisFacad(lc, time_analyser).get_visualization_data()
+        LocationProfileAnalysisFacad(lc, time_analyser).get_location_profile_visualization_data(*location)
+
+    times['facade'], _ = best_time(facades, repeat)
+
+    # The layouts are built once with every analysis result cached, so only the figures are timed
+    data_context.set(data_process, data_fltr)
+    try:
+        get_world_wide_layout(to_date)
+        times['figure build'], world_wide = best_time(lambda: get_world_wide_layout(to_date), repeat)
+        times['profile figure build'], _ = best_time(
+            lambda: get_location_profile_layout(to_date, *location), repeat)
+        times['serialization'], html = best_time(lambda: get_page_html(world_wide.figure), repeat)
+        times['json item serialization'], _ = best_time(lambda: json.dumps(json_item(world_wide.figure)), repeat)
+    finally:
+        data_context.invalidate()
+        analysis_cache.clear()
+
+    times['rows'] = len(data_df)
+    times['html bytes'] = len(html.encode('utf-8'))
+    return times
+
+
+def bench_stages(scales=((80, 44), (200, 180), (400, 720)), file_format=None):
+    """ Every stage from loading the workbooks to the HTML page on generated datasets
+        of (countries, days), see synthetic_data.py """
+    stages = ['load', 'expand', 'merge', 'filter', 'facade', 'figure build', 'profile figure build',
+              'serialization', 'json item serialization']
+    rows = []
+    for num_countries, num_days in scales:
+        dataset = synthetic_data.generate_dataset(num_countries=num_countries, num_days=num_days)
+        times = time_stages(dataset, file_format, repeat=1 if num_countries * num_days > 100000 else 3)
+        rows.append([num_countries, num_days, times['rows'], times['html bytes']] +
+                    [round(times[stage], 4) for stage in stages])
+
+    return print_table(['countries', 'days', 'rows', 'html bytes'] + [f'{stage} (s)' for stage in stages], rows)
+
+
+def bench_top_k(num_countries=(80, 400, 1600), num_days=30, top_k=30):
+    """ The World Wide tab with a bar per country against the top_k countries and an 'Others' bar.
+        The top rows must be the last rows of the fully sorted frame, 'Others' the sum of the rest """
+    rows = []
+    for countries in num_countries:
+        dataset = synthetic_data.generate_dataset(num_countries=countries, num_days=num_days)
+        data_process = DataPreprocessing.from_frames(dataset['report'], dataset['locations'],
+                                                     dataset['risk_assessment'], dataset['testing_laboratories'])
+        data_fltr = DataFiltering(data_process.data_df, data_process.locations_df,
+                                  data_process.risk_assessment_df, data_process.testing_laboratories_df)
+        _, to_date = data_process.get_start_and_end_date()
+
+        lc = DataLocationLevelAnalysis(data_process, data_fltr, to_date=to_date)
+        # The country frames of the World Wide tab: (method, ranking column when it is returned,
+        # columns 'Others' sums up)
+        frames = [
+            (lc.get_total_number_cases_deaths_location_date, 'total_cases', ['total_cases', 'total_deaths']),
+            (lc.get_cases_details_location_date, None, ['total_cases_with_travel_history_to_china',
+                                                        'total_cases_with_transmission_outside_china',
+                                                        'total_cases_with_transmission_site_under_investigation']),
+            (lc.get_total_no_travel_cases_location_date, 'epidemic_outbreak_ratio', ['total_cases']),
+            (lc.get_fat_rate_location_date, 'fatality_rate', [])
+        ]
+        for get_frame, by, sum_columns in frames:
+            full = get_frame('country')
+            top = get_frame('country', top_k=top_k)
+            if len(full) <= top_k:
+                continue
+            full = full.loc[:, ~full.columns.duplicated()]
+            top = top.loc[:, ~top.columns.duplicated()]
+            assert len(top) == top_k + 1 and top.country.iloc[0] == DataLocationLevelAnalysis.others_name
+            assert list(top.columns) == list(full.columns)
+            if by is not None:
+                np.testing.assert_array_equal(top[by].values[1:], np.sort(full[by].values)[-top_k:])
+            for col in sum_columns:
+                assert top[col].sum() == full[col].sum()
+
+        default_top_k = BarParams.top_k
+        data_context.set(data_process, data_fltr)
+        try:
+            sizes, times = {}, {}
+            for k in (None, top_k):
+                BarParams.top_k = k
+                times[k], layout = best_time(lambda: get_world_wide_layout(to_date))
+                sizes[k] = len(get_page_html(layout.figure).encode('utf-8'))
+        finally:
+            BarParams.top_k = default_top_k
+            data_context.invalidate()
+            analysis_cache.clear()
+
+        rows.append([countries, sizes[None], sizes[top_k], '%.4f' % times[None], '%.4f' % times[top_k]])
+
+    return print_table(['countries', 'every country (bytes)', f'top {top_k} (bytes)',
+                        'every country (s)', f'top {top_k} (s)'], rows)
+
+
+def check_downsampled(full_df, df, columns, max_points):
+    """ The downsampled rows must be rows of the full series, at most max_points of them, with its first
+        and last date, and the minimum and maximum of every column in every bucket of days.
+        max_points below one bucket, 2 + 2 * len(columns), is raised to it like get_min_max_positions does """
+    max_points = max(max_points, 2 + 2 * len(columns))
+    assert len(df) <= max_points
+    pd.testing.assert_frame_equal(df, full_df.loc[df.index])
+    assert df.date.iloc[0] == full_df.date.iloc[0] and df.date.iloc[-1] == full_df.date.iloc[-1]
+
+    num_buckets = (max_points - 2) // (2 * len(columns))
+    buckets = np.arange(len(full_df)) * num_buckets // len(full_df)
+    kept_buckets = buckets[full_df.index.get_indexer(df.index)]
+    for col in columns:
+        for aggregate in ('min', 'max'):
+            np.testing.assert_array_equal(df[col].groupby(kept_buckets).agg(aggregate).values,
+                                          full_df[col].groupby(buckets).agg(aggregate).values)
+
+
+def bench_downsampling(num_days=(365, 1095, 3650), num_countries=40):
+    """ The daily series of the World Wide tab against their min/max bucketing to LineGraphParams.max_points,
+        checked against the full series, and the page size with and without it """
+    max_points = LineGraphParams.max_points or 300
+    rows = []
+    for days in num_days:
+        dataset = synthetic_data.generate_dataset(num_countries=num_countries, num_days=days)
+        data_process = DataPreprocessing.from_frames(dataset['report'], dataset['locations'],
+                                                     dataset['risk_assessment'], dataset['testing_laboratories'])
+        data_fltr = DataFiltering(data_process.data_df, data_process.locations_df,
+                                  data_process.risk_assessment_df, data_process.testing_laboratories_df)
+        _, to_date = data_process.get_start_and_end_date()
+
+        time_analyser = DataTimeAnalysis(data_process, data_fltr, to_date=to_date)
+        series = [
+            (time_analyser.daily_and_total_cases('d', 'daily_cases', 'total_cases'), ['total_cases', 'daily_cases']),
+            (time_analyser.daily_and_total_deaths('d', 'daily_deaths', 'total_deaths'), ['total_deaths', 'daily_deaths']),
+            (time_analyser.fatality_rate('d', 'daily_deaths', 'daily_cases'), ['fatal_rate']),
+            (time_analyser.number_of_countries('d'), ['country'])
+        ]
+        for full_df, columns in series:
+            for points in (max_points, 3):
+                check_downsampled(full_df, Utilities.downsample(full_df, columns, points), columns, points)
+
+        default_max_points = LineGraphParams.max_points
+        data_context.set(data_process, data_fltr)
+        try:
+            sizes, times = {}, {}
+            for points in (None, max_points):
+                LineGraphParams.max_points = points
+                times[points], layout = best_time(lambda: get_world_wide_layout(to_date))
+                sizes[points] = len(get_page_html(layout.figure).encode('utf-8'))
+        finally:
+            LineGraphParams.max_points = default_max_points
+            data_context.invalidate()
+            analysis_cache.clear()
+
+        rows.append([days, sizes[None], sizes[max_points], '%.4f' % times[None], '%.4f' % times[max_points]])
+
+    return print_table(['days', 'every day (bytes)', f'{max_points} points (bytes)',
+                        'every day (s)', f'{max_points} points (s)'], rows)
+
+
+BENCHMARKS = {
+    'expand_data_df': bench_expand_data_df,
+    'data_filtering': bench_data_filtering,
+    'mercator_projection': bench_mercator_projection,
+    'append_data': bench_append_data,
+    'compaction': bench_compaction,
+    'metrics': bench_metrics,
+    'stages': bench_stages,
+    'top_k': bench_top_k,
+    'downsampling': bench_downsampling,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the data pipeline')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all of them by default: ' + 
+                        ', '.join(BENCHMARKS))
+    parser.add_argument('--output', default=None, help='save the results to this JSON file')
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(unknown))
+
+    results = {}
+    for name in args.names or list(BENCHMARKS):
+        print(f'== {name}')
+        results[name] = BENCHMARKS[name]()
+
+    if args.output is not None:
+        report = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'machine': platform.platform(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'cpus': os.cpu_count(),
+            'results': results
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1, default=str)
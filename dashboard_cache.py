@@ -0,0 +1,182 @@
+from collections import OrderedDict
+import glob
+import gzip
+import hashlib
+import logging
+import os
+import threading
+
+
+def get_data_version(data_dir='data', pattern='*.xlsx'):
+    """ Fingerprint of the dashboard inputs built from the name, size and
+        modification time of every data file """
+    fingerprint = hashlib.sha1()
+    for file_name in sorted(glob.glob(os.path.join(data_dir, pattern))):
+        stat = os.stat(file_name)
+        fingerprint.update('{}:{}:{};'.format(os.path.basename(file_name),
+                                              stat.st_size, stat.st_mtime_ns).encode())
+    return fingerprint.hexdigest()
+
+
+class RenderedItem:
+    """ A rendered output together with the data version it was built from """
+    def __init__(self, version, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        self.version = version
+        self.body = body
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.gzip_body = None
+
+    def get_gzip_body(self):
+        """ The gzip compressed body, compressed on first use """
+        if self.gzip_body is None:
+            self.gzip_body = gzip.compress(self.body)
+        return self.gzip_body
+
+
+class RenderCache:
+    """ This class keeps rendered outputs in memory and rebuilds them only when the data files change.
+        on_new_version() is called once whenever a new version of the data files is seen.
+        Once a version was published, e.g. by a DataWatcher, the files are no longer checked on get()
+        and the published version is served until the next one.
+        At most max_items outputs are kept, the least recently used are dropped first.
+        A cache with a parent serves the version of the parent, so outputs can be kept apart
+        from each other and still follow the same data """
+    def __init__(self, data_dir='data', pattern='*.xlsx', on_new_version=None, max_items=512, parent=None):
+        self.data_dir = data_dir
+        self.pattern = pattern
+        self.on_new_version = on_new_version
+        self.max_items = max_items
+        self.parent = parent
+        self.version = None
+        self.published = False
+        self.items = OrderedDict()
+        self.build_locks = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_version(self):
+        if self.parent is not None:
+            return self.parent.get_version()
+        if self.published:
+            return self.version
+        version = get_data_version(self.data_dir, self.pattern)
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                if self.on_new_version is not None:
+                    self.on_new_version()
+        return version
+
+    def get_build_lock(self, key):
+        with self.lock:
+            if key not in self.build_locks:
+                self.build_locks[key] = threading.Lock()
+            return self.build_locks[key]
+
+    def get(self, key, build):
+        """ Return the cached item of key, calling build() only if the data changed.
+            Concurrent requests for the same key wait for a single build (single-flight) """
+        version = self.get_version()
+        item = self.items.get(key)
+        if item is not None and item.version == version:
+            self.hits += 1
+            with self.lock:
+                if key in self.items:
+                    self.items.move_to_end(key)
+            return item
+
+        with self.get_build_lock(key):
+            # Another request may have finished the build while we were waiting
+            item = self.items.get(key)
+            if item is not None and item.version == version:
+                self.hits += 1
+                return item
+
+            self.misses += 1
+            item = RenderedItem(version, build())
+            self.store(key, item)
+
+        return item
+
+    def store(self, key, item):
+        with self.lock:
+            self.items[key] = item
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                evicted_key, _ = self.items.popitem(last=False)
+                self.build_locks.pop(evicted_key, None)
+
+    def publish(self, version, bodies):
+        """ Serve version from now on, starting with the prebuilt key -> body outputs.
+            The outputs of older versions are dropped """
+        items = [(key, RenderedItem(version, body)) for key, body in bodies.items()]
+        with self.lock:
+            self.items = OrderedDict((key, item) for key, item in self.items.items() if item.version == version)
+            self.items.update(items)
+            self.version = version
+            self.published = True
+
+    def clear(self):
+        with self.lock:
+            self.items = OrderedDict()
+
+
+class DataWatcher:
+    """ This class polls the data files in a background thread and calls rebuild(version) when they changed.
+        rebuild builds the new version off the request path and publishes it, when it raises the
+        previous version keeps being served. A change is only picked up once the files stayed
+        the same for one interval, so a workbook still being copied is not read """
+    def __init__(self, rebuild, data_dir='data', pattern='*.xlsx', interval=5):
+        self.rebuild = rebuild
+        self.data_dir = data_dir
+        self.pattern = pattern
+        self.interval = interval
+        self.version = None
+        self.failed_version = None
+        self.seen_version = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+        self.stats = {'rebuilds': 0, 'failures': 0}
+
+    def start(self):
+        """ Build the current version in this thread, then watch for changes in the background """
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name='data-watcher', daemon=True)
+        self.check(settle=False)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def check(self, settle=True):
+        version = get_data_version(self.data_dir, self.pattern)
+        seen_version, self.seen_version = self.seen_version, version
+        if version in (self.version, self.failed_version) or (settle and version != seen_version):
+            return
+
+        try:
+            self.rebuild(version)
+        except Exception:
+            # Retried once the files change again
+            self.failed_version = version
+            self.stats['failures'] += 1
+            logging.getLogger(__name__).exception('rebuilding the data version %s failed, '
+                                                  'serving version %s', version, self.version)
+            return
+
+        self.version = version
+        self.failed_version = None
+        self.stats['rebuilds'] += 1
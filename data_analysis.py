@@ -1,14 +1,71 @@
 from data_preprocessing import DataPreprocessing , DataFiltering
+from data_cache import read_excel_cached
+from instrumentation import span
+import data_metrics
 from pprint import pprint
+from collections import OrderedDict
+from functools import lru_cache, wraps
 import pandas as pd
 import numpy as np
-from pyproj import Proj, transform
+from pyproj import Transformer
+import os
+import threading
 import warnings
 from datetime import datetime
 
 
 warnings.filterwarnings("ignore")
 
+class AnalysisCache:
+    """ Bounded LRU cache of analysis results. 
+        The cached results are shared between callers and must not be modified """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            if key in self.items:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return self.items[key]
+            self.misses += 1
+        
+        value = compute()
+        
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+        return value
+    
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self.items), 'maxsize': self.maxsize}
+    
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+analysis_cache = AnalysisCache()
+
+def memoize_analysis(method):
+    """ Cache the results of method in analysis_cache, keyed by the instance 
+        get_cache_key() (data version and to_date) and the call arguments """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__qualname__, self.get_cache_key(), args, tuple(sorted(kwargs.items())))
+        with span(method.__qualname__):
+            return analysis_cache.get_or_compute(key, lambda: method(self, *args, **kwargs))
+    return wrapper
+
 # This class is to get the data summary
 class DataSummary:
     """ This class is to get the data summary"""
@@ -20,6 +77,10 @@ class DataSummary:
         else:
             self.to_date = to_date
     
+    def get_cache_key(self):
+        return self.preprocessed_data.data_version, self.to_date
+    
+    @memoize_analysis
     def get_data_summary(self):
         # define summary needed
         summary = {
@@ -39,24 +100,24 @@ class DataSummary:
         summary['date_summary']['num_of_days'] = num_of_days.days
         
         # get location summary
-        location_df = self.filtered_data.get_specific_date_stats(self.to_date)
-        summary['location_summary']['num_of_countries']=location_df [location_df.total_cases != 0].country.nunique()
-        summary['location_summary']['num_of_regions']=location_df[location_df.total_cases != 0].region.nunique()
-        summary['location_summary']['num_of_continents'] = location_df[location_df.total_cases != 0].continent.nunique()
+        cube = self.filtered_data.get_aggregate_cube()
+        summary['location_summary']['num_of_countries']=cube.count_infected_locations(self.to_date, 'country')
+        summary['location_summary']['num_of_regions']=cube.count_infected_locations(self.to_date, 'region')
+        summary['location_summary']['num_of_continents'] = cube.count_infected_locations(self.to_date, 'continent')
         
         #get cases summary
-        cases_inside_china = self.filtered_data.get_specific_date_location_stats(
-            self.to_date,'country','China').iloc[0].total_cases
-        total_cases = self.filtered_data.get_specific_date_stats(self.to_date).total_cases.sum()
+        china_totals = cube.get_totals(self.to_date, 'country', 'China')
+        world_totals = cube.get_totals(self.to_date)
+        cases_inside_china = china_totals.total_cases
+        total_cases = world_totals.total_cases
         cases_outside_china = total_cases - cases_inside_china
         summary['cases_summary']['cases_inside_china'] = cases_inside_china
         summary['cases_summary']['cases_outside_china'] = cases_outside_china
         summary['cases_summary']['total_cases'] = total_cases
         
         # get deaths summary
-        deaths_inside_china = self.filtered_data.get_specific_date_location_stats(
-            self.to_date,'country','China').iloc[0].total_deaths
-        total_deaths = self.filtered_data.get_specific_date_stats(self.to_date).total_deaths.sum()
+        deaths_inside_china = china_totals.total_deaths
+        total_deaths = world_totals.total_deaths
         deaths_outside_china = total_deaths - deaths_inside_china
         fatality_rate = "%.2f" % ((total_deaths/total_cases) * 100)
         
@@ -86,31 +147,26 @@ class LocationProfileSummary:
             self.to_date = to_date
             
         self.filtered_data = filtered_data
+    
+    def get_cache_key(self):
+        return self.preprocessed_data.data_version, self.to_date
         
+    @memoize_analysis
     def get_specific_location_summary(self, selected_level = 'country',
                                       location_name = 'China'):
         # define summary needed
         summary = {}
-        df = self.filtered_data.get_specific_date_location_stats(self.to_date,selected_level,location_name)
-        df_summary = df[['total_cases','total_deaths']].sum()
+        cube = self.filtered_data.get_aggregate_cube()
+        df_summary = cube.get_totals(self.to_date, selected_level, location_name)
         
         #get first reported date case death
-        first_df = self.filtered_data.get_specific_location_stats(selected_level,location_name)
-        for i,row in first_df.iterrows():
-            if row['total_cases'] > 0:
-                first_case_date = row['date']
-                break        
-                
-            else:
-                first_case_date = 'not registered yet'
+        first_case_date = cube.get_first_date(selected_level, location_name, 'total_cases', self.to_date)
+        if first_case_date is None:
+            first_case_date = 'not registered yet'
         
-        for i,row in first_df.iterrows():
-            if row['total_deaths'] > 0:
-                first_death_date = row['date']
-                #print(first_death_date)
-                break
-            else:
-                first_death_date = 'not registered yet'
+        first_death_date = cube.get_first_date(selected_level, location_name, 'total_deaths', self.to_date)
+        if first_death_date is None:
+            first_death_date = 'not registered yet'
                 
         summary['selected_level'] = selected_level
         summary['location_name']  = location_name
@@ -126,6 +182,10 @@ class LocationProfileSummary:
 # Cases (Location-Based)
 class DataLocationLevelAnalysis:
     """ This class is to get the cases data according to location """
+    
+    # Label of the row that sums up the locations left out of a top_k selection
+    others_name = 'Others'
+    
     def __init__(self, preprocessed_data, filtered_data, to_date = None):
         self.preprocessed_data = preprocessed_data
         self.filtered_data = filtered_data
@@ -133,20 +193,61 @@ class DataLocationLevelAnalysis:
             _,self.to_date = self.preprocessed_data.get_start_and_end_date()
         else:
             self.to_date = to_date
+        self.date_metrics = None
+    
+    def get_date_location_metrics(self, selected_level = 'country', location_name = None):
+        """ The to_date rows of the location (of every country when location_name is None) with their 
+            rate columns, computed once for the whole date and shared by every level """
+        if self.date_metrics is None:
+            self.date_metrics = data_metrics.add_rate_columns(
+                self.filtered_data.get_specific_date_stats(self.to_date))
         
+        df = self.date_metrics
+        if location_name is not None:
+            df = df[df[selected_level] == location_name]
+        return df
+    
+    def sort_or_select_top(self, df, by, selected_level, top_k = None, get_others = None):
+        """ df sorted by the column by, or only its top_k rows by that column preceded by an 'Others' row
+            of the remaining rows, whose values get_others(remaining rows) gives as a dict """
+        if top_k is None or len(df) <= top_k:
+            return df.sort_values(by=[by])
+        
+        top = data_metrics.get_top_positions(df[by].values, top_k)
+        remaining = np.ones(len(df), dtype=bool)
+        remaining[top] = False
+        others = dict(get_others(df[remaining]), **{selected_level: self.others_name, 'country': self.others_name})
+        # The categorical location columns turn into plain ones with the 'Others' label
+        return pd.concat([pd.DataFrame([others]), df.iloc[top]], ignore_index=True, sort=False)
+    
+    @staticmethod
+    def get_location_columns(selected_level):
+        """ The location columns of the frames of a level, the country only once at the country level """
+        return [selected_level] if selected_level == 'country' else [selected_level, 'country']
+    
+    @staticmethod
+    def get_sums(columns):
+        return lambda df: {col: df[col].sum() for col in columns}
+    
+    @staticmethod
+    def get_others_percentage(column, numerator, denominator):
+        """ The rate of the remaining rows as a whole, i.e. weighted by their denominator """
+        return lambda df: {column: data_metrics.get_percentage([df[numerator].sum()], [df[denominator].sum()])[0],
+                           denominator: df[denominator].sum()}
 
-    def get_total_number_cases_deaths_location_date(self,selected_level = 'country', location_name = None):
+    def get_total_number_cases_deaths_location_date(self,selected_level = 'country', location_name = None, top_k = None):
         """ this function to get total cases and deaths according to location from the first day until the selected day """
         if location_name is None:
             df = self.filtered_data.get_specific_date_stats(self.to_date)
         else:
             df = self.filtered_data.get_specific_date_location_stats(self.to_date,selected_level,location_name)
 
-        result = df.sort_values(by=['total_cases'])
-        return result[[selected_level, 'country', 'total_cases', 'total_deaths']]
+        result = self.sort_or_select_top(df, 'total_cases', selected_level, top_k, 
+                                         self.get_sums(['total_cases', 'total_deaths']))
+        return result[self.get_location_columns(selected_level) + ['total_cases', 'total_deaths']]
      
     
-    def get_cases_details_location_date(self,selected_level = 'country', location_name = None):
+    def get_cases_details_location_date(self,selected_level = 'country', location_name = None, top_k = None):
         """ this function to get cases details according to location from the first day until the selected day """
         if location_name is None:
             df = self.filtered_data.get_specific_date_stats(self.to_date)
@@ -157,46 +258,38 @@ class DataLocationLevelAnalysis:
         else :
             df = df
 
-        result = df.sort_values(by=['total_cases'])
-        return result[[selected_level, 'country', 'total_cases_with_travel_history_to_china',
+        result = self.sort_or_select_top(df, 'total_cases', selected_level, top_k, self.get_sums([
+            'total_cases', 'total_cases_with_travel_history_to_china', 'total_cases_with_transmission_outside_china',
+            'total_cases_with_transmission_site_under_investigation']))
+        return result[self.get_location_columns(selected_level) + ['total_cases_with_travel_history_to_china',
                              'total_cases_with_transmission_outside_china',
                               'total_cases_with_transmission_site_under_investigation']]
     
     
     
-    def get_total_no_travel_cases_location_date(self,selected_level = 'country', location_name = None):
+    def get_total_no_travel_cases_location_date(self,selected_level = 'country', location_name = None, top_k = None):
         """ this function to get total cases and cases with no travel history
             according to location from the first day until the selected day """
-        if location_name is None:
-            df = self.filtered_data.get_specific_date_stats(self.to_date)
-        else:
-            df = self.filtered_data.get_specific_date_location_stats(self.to_date,selected_level,location_name)
-            
-        df1 = df[[selected_level, 'country', 'total_cases', 
-                          'total_cases_with_transmission_outside_china']]
-
-        df1 ['epidemic_outbreak_ratio'] = df1 ['total_cases_with_transmission_outside_china'] / df1['total_cases']
-        df1 ['epidemic_outbreak_ratio']= df1 ['epidemic_outbreak_ratio'].apply(lambda x:( x * 100))
-        df1 ['epidemic_outbreak_ratio']= df1 ['epidemic_outbreak_ratio'].apply(lambda x: round(x, 2))
-        result1 = df1.sort_values(by= ['epidemic_outbreak_ratio'])
-        return result1[[selected_level, 'country','total_cases',
-                    'epidemic_outbreak_ratio']].fillna(0)
+        df = self.get_date_location_metrics(selected_level, location_name)
+        df1 = df[self.get_location_columns(selected_level) + ['total_cases', 
+                  'total_cases_with_transmission_outside_china', 'epidemic_outbreak_ratio']]
+        result1 = self.sort_or_select_top(df1, 'epidemic_outbreak_ratio', selected_level, top_k, 
+                                          self.get_others_percentage('epidemic_outbreak_ratio', 
+                                                                     'total_cases_with_transmission_outside_china', 
+                                                                     'total_cases'))
+        return result1[self.get_location_columns(selected_level) + ['total_cases',
+                    'epidemic_outbreak_ratio']].fillna({'total_cases': 0, 'epidemic_outbreak_ratio': 0})
     
     
     
-    def get_fat_rate_location_date(self, selected_level = 'country', location_name = None):
+    def get_fat_rate_location_date(self, selected_level = 'country', location_name = None, top_k = None):
         """ this function to get fatality rate """
-        if location_name is None:
-            df = self.filtered_data.get_specific_date_stats(self.to_date)
-        else:
-            df = self.filtered_data.get_specific_date_location_stats(self.to_date,selected_level,location_name)
-        df1 = df[[selected_level, 'country', 'total_cases','total_deaths']]
-
-        df1['fatality_rate']= df1['total_deaths'] / df1['total_cases']
-        df1['fatality_rate'] = df1['fatality_rate'].apply(lambda x:( x * 100))
-        df1['fatality_rate'] = df1['fatality_rate'].apply(lambda x: round(x, 2))
-        result2 = df1.sort_values(by= ['fatality_rate'])
-        return result2[[selected_level,'country','fatality_rate']].fillna(0)
+        df = self.get_date_location_metrics(selected_level, location_name)
+        df1 = df[self.get_location_columns(selected_level) + ['total_cases','total_deaths', 'fatality_rate']]
+        result2 = self.sort_or_select_top(df1, 'fatality_rate', selected_level, top_k, 
+                                          self.get_others_percentage('fatality_rate', 'total_deaths', 'total_cases'))
+        # Only the rates, the categorical location columns cannot take a 0
+        return result2[self.get_location_columns(selected_level) + ['fatality_rate']].fillna({'fatality_rate': 0})
     
     def get_all_data(self):
         result1= self.get_total_no_travel_cases_location_date()
@@ -207,6 +300,10 @@ class DataLocationLevelAnalysis:
 
 class DataTimeAnalysis:
     """ This class is to get the cases data according to location """
+    
+    # rate -> prefix of the per period columns
+    period_names = {'d': 'daily', 'w': 'weekly', 'm': 'monthly'}
+    
     def __init__(self, preprocessed_data,filtered_data,to_date = None):
         self.preprocessed_data = preprocessed_data
         if to_date is None:
@@ -215,57 +312,41 @@ class DataTimeAnalysis:
             self.to_date = to_date
         self.filtered_data = filtered_data
     
+    def get_date_sums(self, selected_level = None, location_name = None):
+        """ Per-date sums of the location (of the world when selected_level is None) until to_date """
+        cube = self.filtered_data.get_aggregate_cube()
+        return cube.get_sums(selected_level, location_name, self.to_date)
+    
     def daily_and_total_cases(self, rate,daily_col, total_col,selected_level = None,location_name= None):
         """ this function to get  number of cases  per day,month """
-        if selected_level is None:
-            df = self.filtered_data.get_until_specific_date_stats(self.to_date).set_index('date')
-        else:
-            df = self.filtered_data.get_until_date_location_stats(self.to_date,selected_level,location_name).set_index('date')
-        daily_vals = df.resample(rate)[daily_col].sum()
+        df = self.get_date_sums(selected_level, location_name)
+        daily_vals = df[daily_col].resample(rate).sum()
         total_vals = daily_vals.cumsum()
-        if rate == 'd':
-            result = pd.DataFrame({'daily_cases': daily_vals, 'total_cases': total_vals})
-        else:
-            result = pd.DataFrame({'monthly_cases': daily_vals, 'total_cases': total_vals})
+        result = pd.DataFrame({f'{self.period_names[rate]}_cases': daily_vals, 'total_cases': total_vals})
         return result.reset_index()
     
     def daily_and_total_deaths(self, rate, daily_col, total_col,selected_level = None,location_name= None):
         """ this function to get  number of deaths per day,month """
-        if selected_level is None:
-            df = self.filtered_data.get_until_specific_date_stats(self.to_date).set_index('date')
-        else:
-            df = self.filtered_data.get_until_date_location_stats(self.to_date,selected_level,location_name).set_index('date')
-        daily_vals = df.resample(rate)[daily_col].sum()
+        df = self.get_date_sums(selected_level, location_name)
+        daily_vals = df[daily_col].resample(rate).sum()
         total_vals = daily_vals.cumsum()
-        if rate == 'd':
-            result = pd.DataFrame({'daily_deaths': daily_vals, 'total_deaths': total_vals})
-        else:
-            result = pd.DataFrame({'monthly_deaths': daily_vals, 'total_deaths': total_vals})
+        result = pd.DataFrame({f'{self.period_names[rate]}_deaths': daily_vals, 'total_deaths': total_vals})
         return result.reset_index()
      
     
     def fatality_rate(self, rate, deaths_col, cases_col,selected_level = None,location_name= None):
         """ this function to get fatality rate per day,month """
-        if selected_level is None:
-            df = self.filtered_data.get_until_specific_date_stats(self.to_date).set_index('date')
-        else:
-            df = self.filtered_data.get_until_date_location_stats(self.to_date,selected_level,location_name).set_index('date')
-        deaths_vals = df.resample(rate)[deaths_col].sum()
-        cases_vals =  df.resample(rate)[cases_col].sum()
+        df = self.get_date_sums(selected_level, location_name)
+        deaths_vals = df[deaths_col].resample(rate).sum()
+        cases_vals =  df[cases_col].resample(rate).sum()
         fat_vals = deaths_vals / cases_vals
-        result = pd.DataFrame({'fatal_rate':fat_vals})
-        result['fatal_rate'] = result['fatal_rate'].apply(lambda x:( x * 100))
-        result['fatal_rate'] = result['fatal_rate'].apply(lambda x: round(x, 2))
+        result = pd.DataFrame({'fatal_rate': data_metrics.to_percentage(fat_vals.values)}, index=fat_vals.index)
         return result[['fatal_rate']].reset_index()
     
     def number_of_countries(self, rate='d',selected_level = None,location_name= None):
         """ Number of countries infected over time """
-        if selected_level is None:
-            df = self.filtered_data.get_until_specific_date_stats(self.to_date).set_index('date')
-        else:
-            df = self.filtered_data.get_until_date_location_stats(self.to_date,selected_level,location_name).set_index('date')
-        df = df[df['total_cases'] != 0]
-        result = df.resample(rate)['country'].apply(lambda x: x.nunique())
+        cube = self.filtered_data.get_aggregate_cube()
+        result = cube.get_infected_countries(rate, selected_level, location_name, self.to_date)
         result = pd.DataFrame(result).reset_index()
         
         return result
@@ -276,9 +357,14 @@ class AnalysisFacad:
         self.location_based_data = location_based_data
         self.data_time = data_time
     
+    def get_cache_key(self):
+        return (self.location_based_data.preprocessed_data.data_version, 
+                self.location_based_data.to_date, self.data_time.to_date)
     
-    def get_visualization_data(self):
-        
+    @memoize_analysis
+    def get_visualization_data(self, top_k = None):
+        """ top_k keeps only the countries with the largest values in the country frames,
+            the others are summed up in an 'Others' row """
         visualization = {}
         
         visualization['region_total_cases_death']=self.location_based_data.get_total_number_cases_deaths_location_date('region')
@@ -291,10 +377,10 @@ class AnalysisFacad:
         visualization['continent_outbreak_ratio'] =self.location_based_data.get_total_no_travel_cases_location_date('continent')
         visualization['continent_fatality_rate'] =self.location_based_data.get_fat_rate_location_date('continent')
         
-        visualization['country_total_cases_death']=self.location_based_data.get_total_number_cases_deaths_location_date('country')
-        visualization['country_cases_details'] =self.location_based_data.get_cases_details_location_date('country')
-        visualization['country_outbreak_ratio'] =self.location_based_data.get_total_no_travel_cases_location_date('country')
-        visualization['country_fatality_rate'] =self.location_based_data.get_fat_rate_location_date('country')
+        visualization['country_total_cases_death']=self.location_based_data.get_total_number_cases_deaths_location_date('country', top_k=top_k)
+        visualization['country_cases_details'] =self.location_based_data.get_cases_details_location_date('country', top_k=top_k)
+        visualization['country_outbreak_ratio'] =self.location_based_data.get_total_no_travel_cases_location_date('country', top_k=top_k)
+        visualization['country_fatality_rate'] =self.location_based_data.get_fat_rate_location_date('country', top_k=top_k)
         
         visualization['num_countries_per_day'] = self.data_time.number_of_countries('d')
         visualization['num_countries_per_month'] = self.data_time.number_of_countries('m')
@@ -315,7 +401,12 @@ class LocationProfileAnalysisFacad:
     def __init__(self,location_based_data,data_time):
         self.location_based_data = location_based_data
         self.data_time = data_time
+    
+    def get_cache_key(self):
+        return (self.location_based_data.preprocessed_data.data_version, 
+                self.location_based_data.to_date, self.data_time.to_date)
         
+    @memoize_analysis
     def get_location_profile_visualization_data(self,selected_level,location_name):
         location_profile_visualization = {}
         location_profile_visualization['total_cases_death']=self.location_based_data.get_total_number_cases_deaths_location_date(selected_level,location_name)
@@ -334,26 +425,54 @@ class LocationProfileAnalysisFacad:
         
         return location_profile_visualization
         
+@lru_cache(maxsize=None)
+def get_mercator_transformer():
+    return Transformer.from_crs('epsg:4326', 'epsg:3857', always_xy=True)
+
+def to_mercator(long, lat):
+    """ Project whole arrays of WGS84 longitudes and latitudes to Web Mercator x and y """
+    return get_mercator_transformer().transform(np.asarray(long, dtype=float), np.asarray(lat, dtype=float))
+
 class DataCountryAnalysis:
-    def __init__(self, preprocessed_data, filtered_data, coordinates_file = 'data/coordinates.xlsx', to_date = None):
+    
+    # coordinates file (None for the preprocessed locations) -> (file stat or data version, 
+    # coordinates with their mercator projection)
+    projected_coordinates = {}
+    
+    def __init__(self, preprocessed_data, filtered_data, coordinates_file = None, to_date = None):
         self.preprocessed_data = preprocessed_data
         self.filtered_data = filtered_data
-        self.coordinates_data = pd.read_excel(coordinates_file)
-        self.add_mercator_coordinates()
+        self.coordinates_data = self.get_projected_coordinates(coordinates_file)
         if to_date is None:
             _, self.to_date = self.preprocessed_data.get_start_and_end_date()
             
         else:
             self.to_date = to_date
+    
+    def get_projected_coordinates(self, coordinates_file):
+        """ Read and project the coordinates file once, until it changes. Without a file the
+            locations of the preprocessed data are used, projected once per data version """
+        if coordinates_file is None:
+            file_stat = self.preprocessed_data.data_version
+        else:
+            stat = os.stat(coordinates_file)
+            file_stat = (stat.st_mtime_ns, stat.st_size)
+        cached = DataCountryAnalysis.projected_coordinates.get(coordinates_file)
+        if cached is None or cached[0] != file_stat:
+            if coordinates_file is None:
+                self.coordinates_data = self.preprocessed_data.locations_df.copy()
+            else:
+                self.coordinates_data = read_excel_cached(coordinates_file)
+            self.add_mercator_coordinates()
+            cached = (file_stat, self.coordinates_data)
+            DataCountryAnalysis.projected_coordinates[coordinates_file] = cached
+            
+        return cached[1].copy()
         
     def add_mercator_coordinates(self):
-        in_wgs = Proj(init='epsg:4326')
-        out_mercator = Proj(init='epsg:3857')
-        for i in self.coordinates_data.index:
-            self.coordinates_data.at[i, 'merc_lat'], self.coordinates_data.at[i, 'merc_long'] = transform(in_wgs, 
-                                                                 out_mercator, 
-                                                                 self.coordinates_data.at[i, 'long'], 
-                                                                 self.coordinates_data.at[i, 'lat'])
+        # merc_lat holds the projected x (from the longitude) and merc_long the y, as CountriesMap expects
+        self.coordinates_data['merc_lat'], self.coordinates_data['merc_long'] = to_mercator(
+            self.coordinates_data['long'], self.coordinates_data['lat'])
 
     def get_total_number_cases_deaths(self):
         #_, to_date = self.preprocessed_data.get_start_and_end_date()
@@ -0,0 +1,145 @@
+""" The analysis results as compact, JSON serializable data for the application's /api routes """
+import json
+
+import numpy as np
+import pandas as pd
+
+from data_preprocessing import data_context, AggregateCube
+from data_analysis import DataSummary, LocationProfileSummary, AnalysisFacad, DataTimeAnalysis, \
+    DataLocationLevelAnalysis, LocationProfileAnalysisFacad
+
+
+# kind -> DataTimeAnalysis method and the columns it is called with
+time_series = {
+    'cases': ('daily_and_total_cases', 'daily_cases', 'total_cases'),
+    'deaths': ('daily_and_total_deaths', 'daily_deaths', 'total_deaths'),
+    'fatality_rate': ('fatality_rate', 'daily_deaths', 'daily_cases'),
+    'countries': ('number_of_countries',)
+}
+
+rates = ['d', 'w', 'm']
+
+
+def to_plain(value):
+    """ Convert frames, numpy scalars and NaN to values json.dumps accepts """
+    if isinstance(value, pd.DataFrame):
+        # {"columns": [...], "data": [[...], ...]}
+        return json.loads(value.to_json(orient='split', date_format='iso', index=False))
+    if isinstance(value, dict):
+        return {str(k): to_plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_plain(v) for v in value]
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else float(value)
+    return value
+
+
+def dumps(value):
+    return json.dumps(to_plain(value), separators=(',', ':'))
+
+
+def parse_date(value, default, date_range=None):
+    """ The date of value, default when it is None. Raise ValueError outside of the (first, last) date_range """
+    if value is None:
+        return default
+    try:
+        date = pd.Timestamp(value).date()
+    except ValueError:
+        raise ValueError(f'invalid date: {value}')
+    if date_range is not None and not date_range[0] <= date <= date_range[1]:
+        raise ValueError(f'date must be between {date_range[0]} and {date_range[1]}: {value}')
+    return date
+
+
+def parse_params(params):
+    """ The request parameters, name -> value, validated and with their defaults,
+        so that the requests of the same data get the same parameters, e.g. to key their responses.
+        Raise ValueError for an invalid value and KeyError for an unknown location """
+    data_process, data_fltr = data_context.get()
+    date_range = data_process.get_start_and_end_date()
+    params = dict(params)
+
+    if 'kind' in params:
+        params['kind'] = params['kind'] or 'cases'
+        if params['kind'] not in time_series:
+            raise ValueError(f'kind must be one of {list(time_series)}')
+    if 'rate' in params:
+        params['rate'] = params['rate'] or 'd'
+        if params['rate'] not in rates:
+            raise ValueError(f'rate must be one of {rates}')
+    if params.get('level') is not None:
+        check_location(data_fltr, params['level'], params.get('location'))
+    elif 'location' in params:
+        # Ignored without a level
+        params['location'] = None
+    if 'from' in params:
+        params['from'] = parse_date(params['from'], None, date_range)
+    if 'to' in params:
+        params['to'] = parse_date(params['to'], date_range[1], date_range)
+    return params
+
+
+def get_analysers(to_date=None):
+    data_process, data_fltr = data_context.get()
+    date_range = data_process.get_start_and_end_date()
+    return data_process, data_fltr, parse_date(to_date, date_range[1], date_range)
+
+
+def check_location(data_fltr, selected_level, location_name):
+    """ Raise ValueError for an unknown level and KeyError for an unknown location """
+    if selected_level not in AggregateCube.levels:
+        raise ValueError(f'level must be one of {AggregateCube.levels}')
+    if location_name not in data_fltr.get_aggregate_cube().level_countries[selected_level]:
+        raise KeyError(location_name)
+
+
+def get_summary(to_date=None):
+    data_process, data_fltr, to_date = get_analysers(to_date)
+    return DataSummary(data_process, data_fltr, to_date=to_date).get_data_summary()
+
+
+def get_location_summary(selected_level, location_name, to_date=None):
+    data_process, data_fltr, to_date = get_analysers(to_date)
+    check_location(data_fltr, selected_level, location_name)
+    lc_summary = LocationProfileSummary(data_process, data_fltr, to_date=to_date)
+    return lc_summary.get_specific_location_summary(selected_level, location_name)
+
+
+def get_visualization_data(selected_level=None, location_name=None, to_date=None):
+    """ The world wide tables, or the profile tables of a location """
+    data_process, data_fltr, to_date = get_analysers(to_date)
+    time_analyser = DataTimeAnalysis(data_process, data_fltr, to_date=to_date)
+    lc = DataLocationLevelAnalysis(data_process, data_fltr, to_date=to_date)
+
+    if selected_level is None:
+        return AnalysisFacad(lc, time_analyser).get_visualization_data()
+
+    check_location(data_fltr, selected_level, location_name)
+    return LocationProfileAnalysisFacad(lc, time_analyser).get_location_profile_visualization_data(
+        selected_level, location_name)
+
+
+def get_time_series(kind=None, rate=None, selected_level=None, location_name=None, from_date=None, to_date=None):
+    """ One DataTimeAnalysis series between from_date and to_date, daily cases by default """
+    kind = kind or 'cases'
+    rate = rate or 'd'
+    if kind not in time_series:
+        raise ValueError(f'kind must be one of {list(time_series)}')
+    if rate not in rates:
+        raise ValueError(f'rate must be one of {rates}')
+
+    data_process, data_fltr, to_date = get_analysers(to_date)
+    if selected_level is not None:
+        check_location(data_fltr, selected_level, location_name)
+
+    method, *columns = time_series[kind]
+    time_analyser = DataTimeAnalysis(data_process, data_fltr, to_date=to_date)
+    result = getattr(time_analyser, method)(rate, *columns, selected_level=selected_level,
+                                            location_name=location_name)
+
+    from_date = parse_date(from_date, None, data_process.get_start_and_end_date())
+    if from_date is not None:
+        result = result[result.date >= pd.Timestamp(from_date)]
+    return result
@@ -0,0 +1,299 @@
+""" Columnar cache of the data/*.xlsx workbooks.
+
+The first read of a workbook converts it to a Feather file stored in a `.cache`
+directory next to it; later reads load the Feather file instead of parsing the
+workbook again. A cached copy is used as long as the workbook keeps its size and
+modification time, or, when it was only touched, its content hash.
+
+It also keeps a snapshot of the fully preprocessed data_df as an Arrow IPC
+file. The snapshot is opened with memory mapping, so every worker process
+shares the same pages and skips the preprocessing as long as the source
+workbooks are unchanged.
+
+Pre-warm the cache at deploy time with:
+
+    python data_cache.py --data-dir data --snapshot
+"""
+import argparse
+from datetime import datetime
+import glob
+import hashlib
+import json
+import logging
+import os
+
+import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+CACHE_FORMAT_VERSION = 2
+
+# Bump whenever the preprocessing changes the content of data_df
+SNAPSHOT_FORMAT_VERSION = 2
+
+# A string column is stored as categorical when it has at most this ratio of distinct values
+CATEGORY_RATIO = 0.5
+
+stats = {'hits': 0, 'misses': 0}
+
+
+def get_file_hash(file_name):
+    file_hash = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_cache_paths(file_name, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(file_name), '.cache')
+    base_name = os.path.splitext(os.path.basename(file_name))[0]
+    return os.path.join(cache_dir, base_name + '.feather'), os.path.join(cache_dir, base_name + '.json')
+
+
+def read_meta(meta_path):
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('format_version') != CACHE_FORMAT_VERSION:
+        return None
+    return meta
+
+
+def write_atomically(path, write):
+    """ Call write(temp_path) and move the result to path in one step """
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def write_meta(meta_path, meta):
+    def write(temp_path):
+        with open(temp_path, 'w') as f:
+            json.dump(meta, f)
+    write_atomically(meta_path, write)
+
+
+def is_string_column(column):
+    values = column.dropna()
+    return column.dtype == object and len(values) > 0 and \
+        values.map(type).eq(str).all()
+
+
+def to_single_types(df):
+    """ Arrow stores one type per column: the object columns mixing datetimes and strings,
+        e.g. dates Excel did not recognize, are parsed like pd.to_datetime does downstream,
+        the other mixed columns are stored as strings """
+    for col in df.columns:
+        if df[col].dtype != object:
+            continue
+        values = df[col].dropna()
+        types = set(values.map(type))
+        if len(types) <= 1:
+            continue
+
+        if any(issubclass(t, datetime) for t in types):
+            try:
+                df[col] = pd.to_datetime(df[col])
+                continue
+            except (TypeError, ValueError):
+                pass
+        df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return df
+
+
+def to_columnar_dtypes(df):
+    """ Store low-cardinality string columns as categoricals """
+    df = df.copy()
+    for col in df.columns:
+        if is_string_column(df[col]) and df[col].nunique() <= CATEGORY_RATIO * len(df):
+            df[col] = df[col].astype('category')
+    return df
+
+
+def from_columnar_dtypes(df, categories):
+    """ Give back the frame pd.read_excel would have returned, optionally keeping the categoricals """
+    if categories:
+        return df
+
+    for col in df.columns:
+        if df[col].dtype.name == 'category':
+            df[col] = df[col].astype(object)
+    return df
+
+
+def get_valid_meta(file_name, table_path, meta_path):
+    """ The cache metadata of file_name, or None when the cached table is missing or stale """
+    meta = read_meta(meta_path)
+    if meta is None or not os.path.exists(table_path):
+        return None
+
+    stat = os.stat(file_name)
+    if (meta['mtime_ns'], meta['size']) == (stat.st_mtime_ns, stat.st_size):
+        return meta
+
+    # The workbook was touched or copied, it is still valid if its content did not change
+    if meta['sha1'] != get_file_hash(file_name):
+        return None
+
+    meta['mtime_ns'], meta['size'] = stat.st_mtime_ns, stat.st_size
+    write_meta(meta_path, meta)
+    return meta
+
+
+def write_cache(df, file_name, table_path, meta_path):
+    stat = os.stat(file_name)
+    meta = {
+        'format_version': CACHE_FORMAT_VERSION,
+        'source': os.path.basename(file_name),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha1': get_file_hash(file_name)
+    }
+
+    os.makedirs(os.path.dirname(table_path), exist_ok=True)
+    try:
+        write_atomically(table_path, lambda temp_path: to_columnar_dtypes(df).to_feather(temp_path))
+    except (pyarrow.ArrowException, TypeError, ValueError):
+        logging.getLogger(__name__).warning('caching %s failed, it is read from the workbook', 
+                                            file_name, exc_info=True)
+        return False
+
+    write_meta(meta_path, meta)
+    return True
+
+
+def read_excel_cached(file_name, cache_dir=None, categories=False):
+    """ pd.read_excel(file_name), see to_single_types, served from the columnar cache when it is up to date """
+    if pyarrow is None:
+        return to_single_types(pd.read_excel(file_name))
+
+    table_path, meta_path = get_cache_paths(file_name, cache_dir)
+    if get_valid_meta(file_name, table_path, meta_path) is not None:
+        stats['hits'] += 1
+        return from_columnar_dtypes(pd.read_feather(table_path), categories)
+
+    stats['misses'] += 1
+    df = to_single_types(pd.read_excel(file_name))
+    write_cache(df, file_name, table_path, meta_path)
+    return df
+
+
+def get_sources_fingerprint(file_names):
+    """ Content hash of the files a snapshot is built from """
+    fingerprint = hashlib.sha1(str(SNAPSHOT_FORMAT_VERSION).encode())
+    for file_name in file_names:
+        fingerprint.update(os.path.basename(file_name).encode())
+        fingerprint.update(get_file_hash(file_name).encode())
+    return fingerprint.hexdigest()
+
+
+def get_snapshot_path(name, fingerprint, cache_dir=os.path.join('data', '.cache')):
+    return os.path.join(cache_dir, f'{name}-{fingerprint[:16]}.arrow')
+
+
+def save_snapshot(df, name, fingerprint, cache_dir=os.path.join('data', '.cache')):
+    """ Write df as the snapshot of the given source fingerprint and drop older versions """
+    if pyarrow is None:
+        return None
+
+    snapshot_path = get_snapshot_path(name, fingerprint, cache_dir)
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+
+    def write(temp_path):
+        with pyarrow.OSFile(temp_path, 'wb') as sink:
+            writer = pyarrow.RecordBatchFileWriter(sink, table.schema)
+            writer.write_table(table)
+            writer.close()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    write_atomically(snapshot_path, write)
+
+    for old_path in glob.glob(os.path.join(cache_dir, f'{name}-*.arrow')):
+        if old_path != snapshot_path:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+    return snapshot_path
+
+
+def load_snapshot(name, fingerprint, cache_dir=os.path.join('data', '.cache')):
+    """ Memory map the snapshot of the given source fingerprint, None when there is none """
+    if pyarrow is None:
+        return None
+
+    snapshot_path = get_snapshot_path(name, fingerprint, cache_dir)
+    if not os.path.exists(snapshot_path):
+        return None
+
+    # The frame keeps a reference to the mapping: numeric columns without nulls
+    # are not copied but read straight from the shared pages
+    source = pyarrow.memory_map(snapshot_path, 'r')
+    table = pyarrow.ipc.open_file(source).read_all()
+    df = table.to_pandas(split_blocks=True)
+
+    # Arrow gives back None for missing strings where pandas had NaN
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].where(df[col].notna())
+    return df
+
+
+def warm_cache(data_dir='data', cache_dir=None):
+    """ Convert every workbook of data_dir whose cached copy is missing or stale """
+    converted = []
+    for file_name in sorted(glob.glob(os.path.join(data_dir, '*.xlsx'))):
+        table_path, meta_path = get_cache_paths(file_name, cache_dir)
+        if get_valid_meta(file_name, table_path, meta_path) is not None:
+            continue
+
+        if write_cache(to_single_types(pd.read_excel(file_name)), file_name, table_path, meta_path):
+            converted.append(file_name)
+    return converted
+
+
+def clear_cache(data_dir='data', cache_dir=None):
+    for file_name in glob.glob(os.path.join(data_dir, '*.xlsx')):
+        for path in get_cache_paths(file_name, cache_dir):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-warm the columnar cache of the data workbooks')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--clear', action='store_true', help='remove the cached files first')
+    parser.add_argument('--snapshot', action='store_true', 
+                        help='also build the snapshot of the preprocessed data_df')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(levelname)s %(message)s')
+
+    if pyarrow is None:
+        parser.error('pyarrow is required to build the columnar cache')
+
+    if args.clear:
+        clear_cache(args.data_dir, args.cache_dir)
+
+    for file_name in warm_cache(args.data_dir, args.cache_dir):
+        print(f'cached {file_name}')
+
+    if args.snapshot:
+        # Imported here because data_preprocessing reads its files through this module
+        from data_preprocessing import DataPreprocessing
+        data_process = DataPreprocessing()
+        print('built the data_df snapshot')
+        print(data_process.get_memory_report())
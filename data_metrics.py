@@ -0,0 +1,111 @@
+""" Vectorized versions of the per-value metrics of the analysis and the visualization.
+
+Every function takes whole columns and gives back the same values the per-row
+lambdas they replace computed one by one.
+"""
+import numpy as np
+
+
+# np.round works on values * 10 ** decimals, whose rounding error may move it across a tie.
+# Values this close to a tie are rounded by Python's round, which is exact
+TIE_TOLERANCE = 1e-6
+
+# Above this scaled magnitude the doubles have no fractional part left
+EXACT_INTEGER_LIMIT = 2.0 ** 52
+
+
+def round_like_python(values, decimals=2):
+    """ round(x, decimals) of every value, computed with NumPy """
+    values = np.asarray(values, dtype=np.float64)
+    result = np.round(values, decimals)
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        scaled = values * 10.0 ** decimals
+        near_tie = (np.abs(scaled - np.floor(scaled) - 0.5) < TIE_TOLERANCE) | \
+                   (np.abs(scaled) >= EXACT_INTEGER_LIMIT)
+
+    for i in np.flatnonzero(near_tie & np.isfinite(values)):
+        result[i] = round(float(values[i]), decimals)
+    return result
+
+
+def get_ratio(numerator, denominator):
+    """ numerator / denominator as floats, NaN for 0 / 0 and inf for x / 0 like pandas """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.true_divide(np.asarray(numerator, dtype=np.float64), np.asarray(denominator, dtype=np.float64))
+
+
+def to_percentage(ratio, decimals=2):
+    """ ratio * 100 rounded to decimals """
+    return round_like_python(np.asarray(ratio, dtype=np.float64) * 100, decimals)
+
+
+def get_percentage(numerator, denominator, decimals=2):
+    return to_percentage(get_ratio(numerator, denominator), decimals)
+
+
+def log_scale(values, factor=50, offset=0.1):
+    """ log(x + offset) * factor, 0 where x is 0 """
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(values != 0, np.log(values + offset) * factor, 0.0)
+
+
+def marker_size(values, scale=np.log10, factor=10, offset=0.5):
+    """ scale(x + offset) * factor, 0 where x is 0 """
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(values != 0, scale(values + offset) * factor, 0.0)
+
+
+def get_top_positions(values, k):
+    """ Positions of the k largest values in ascending order of value, ties in their original order.
+        The k values are picked with a partial selection, only they get sorted. NaN counts as the smallest """
+    values = np.asarray(values, dtype=np.float64)
+    values = np.where(np.isnan(values), -np.inf, values)
+    if k >= len(values):
+        return np.argsort(values, kind='mergesort')
+    top = np.sort(np.argpartition(-values, k - 1)[:k])
+    return top[np.argsort(values[top], kind='mergesort')]
+
+
+def get_bucket_bounds(num_values, num_buckets):
+    """ The bucket of every position and the first and last position of every bucket,
+        for num_buckets buckets of consecutive positions of about the same size """
+    buckets = np.arange(num_values) * num_buckets // num_values
+    starts = np.searchsorted(buckets, np.arange(num_buckets))
+    ends = np.append(starts[1:], num_values) - 1
+    return buckets, starts, ends
+
+
+def get_min_max_positions(columns, max_points):
+    """ Positions of the rows to draw the equally long columns with at most max_points rows: the first and
+        the last row, and the rows of the minimum and the maximum of every column in each bucket of
+        consecutive rows. Every position when there are at most max_points rows.
+        One bucket takes 2 + 2 * len(columns) rows, a smaller max_points is raised to that floor """
+    num_values = len(columns[0])
+    max_points = max(max_points, 2 + 2 * len(columns))
+    if num_values <= max_points:
+        return np.arange(num_values)
+
+    num_buckets = (max_points - 2) // (2 * len(columns))
+    buckets, starts, ends = get_bucket_bounds(num_values, num_buckets)
+
+    positions = [np.array([0, num_values - 1])]
+    for values in columns:
+        values = np.asarray(values, dtype=np.float64)
+        # Sorted by bucket then value, the first row of a bucket holds its minimum and the last its maximum.
+        # NaN is only picked when the whole bucket is NaN
+        min_order = np.lexsort((np.where(np.isnan(values), np.inf, values), buckets))
+        max_order = np.lexsort((np.where(np.isnan(values), -np.inf, values), buckets))
+        positions += [min_order[starts], max_order[ends]]
+    return np.unique(np.concatenate(positions))
+
+
+def add_rate_columns(df):
+    """ A copy of df with the epidemic_outbreak_ratio and fatality_rate percentages of every row """
+    df = df.copy()
+    df['epidemic_outbreak_ratio'] = get_percentage(df['total_cases_with_transmission_outside_china'].values,
+                                                   df['total_cases'].values)
+    df['fatality_rate'] = get_percentage(df['total_deaths'].values, df['total_cases'].values)
+    return df
@@ -1,20 +1,82 @@
+from data_cache import read_excel_cached, get_sources_fingerprint, load_snapshot, save_snapshot
+from instrumentation import span
+import contextlib
+import copy
+import itertools
+import numpy as np
 import pandas as pd
+import threading
 
 class DataPreprocessing:
     """ This class is responsible for data reading and cleaning """
+    
+    # How many times this process parsed the report, expanded it or opened its snapshot instead
+    stats = {'parse': 0, 'expand': 0, 'snapshot': 0}
+    
+    # Every loaded dataset gets a new data_version, results cached for an older one are never reused
+    versions = itertools.count(1)
+    
+    # Columns filled with 0 for the days a country has no report
+    count_columns = ['total_cases', 'total_deaths',
+                     'total_cases_with_travel_history_to_china',
+                     'total_cases_with_transmission_outside_china',
+                     'total_cases_with_transmission_site_under_investigation']
+    
+    # Columns stored as categoricals, with the same categories in data_df and locations_df
+    location_columns = ['country', 'region', 'continent']
+    
     def __init__(self, dataset_file_name='data/corona_report.xlsx', 
                  locations_file_name='data/coordinates.xlsx',
                  risk_assessment_file_name='data/risk_assessment.xlsx',
-                 testing_laboratories='data/testing_laboratories.xlsx'):
+                 testing_laboratories='data/testing_laboratories.xlsx', use_snapshot=True):
+        
+        self.data_version = next(DataPreprocessing.versions)
+        with span('read workbooks'):
+            self.locations_df = read_excel_cached(locations_file_name)
+            self.risk_assessment_df = read_excel_cached(risk_assessment_file_name)
+            self.testing_laboratories_df = read_excel_cached(testing_laboratories)
         
-        self.data_df = pd.read_excel(dataset_file_name)
-        self.locations_df = pd.read_excel(locations_file_name)
-        self.risk_assessment_df = pd.read_excel(risk_assessment_file_name)
-        self.testing_laboratories_df = pd.read_excel(testing_laboratories)
+        # The preprocessed data_df only depends on the report and the locations
+        fingerprint = get_sources_fingerprint([dataset_file_name, locations_file_name])
+        with span('load snapshot'):
+            self.data_df = load_snapshot('data_df', fingerprint) if use_snapshot else None
+        if self.data_df is not None:
+            DataPreprocessing.stats['snapshot'] += 1
+            # Only gives locations_df the categories of the snapshot
+            self.compact_data_df()
+            return
         
-        self.convert_date_str_to_datetime()
-        self.expand_data_df()
-        self.merge_location_info()
+        with span('parse report'):
+            self.data_df = read_excel_cached(dataset_file_name)
+        DataPreprocessing.stats['parse'] += 1
+        self.preprocess()
+        
+        if use_snapshot:
+            with span('save snapshot'):
+                save_snapshot(self.data_df, 'data_df', fingerprint)
+    
+    @classmethod
+    def from_frames(cls, data_df, locations_df, risk_assessment_df, testing_laboratories_df):
+        """ Preprocess frames that are already in memory, e.g. generated ones, instead of the workbooks """
+        data_process = cls.__new__(cls)
+        data_process.data_version = next(cls.versions)
+        data_process.locations_df = locations_df.copy()
+        data_process.risk_assessment_df = risk_assessment_df
+        data_process.testing_laboratories_df = testing_laboratories_df
+        data_process.data_df = data_df.copy()
+        data_process.preprocess()
+        return data_process
+    
+    def preprocess(self):
+        """ Turn the raw report into data_df: one row per country and day with its location """
+        with span('convert dates'):
+            self.convert_date_str_to_datetime()
+        with span('expand'):
+            self.expand_data_df()
+        with span('merge locations'):
+            self.merge_location_info()
+        with span('compact'):
+            self.compact_data_df()
         
     def change_country_name(self, old_name, new_name):
         self.data_df.country = self.data_df.country.apply(
@@ -24,27 +86,50 @@ class DataPreprocessing:
         """ This is necessary for resampling the dataframe """
         self.data_df.date = pd.to_datetime(self.data_df.date)
     
-    def expand_data_df(self):
+    def expand_data_df(self, engine='vectorized'):
         """ Generate one data point for each country per each day """
+        DataPreprocessing.stats['expand'] += 1
+        
+        if engine == 'vectorized':
+            self.data_df = self.expand_vectorized(self.data_df)
+        else:
+            self.data_df = self.expand_per_day(self.data_df)
+    
+    @staticmethod
+    def expand_vectorized(data_df):
+        """ Reindex once over the full date x country product and compute the 
+            daily values with a diff grouped by country """
+        countries = sorted(data_df.country.unique().tolist())
+        dates = pd.date_range(data_df.date.min().date(), data_df.date.max().date())
+        full_index = pd.MultiIndex.from_product([dates, countries], names=['date', 'country'])
         
-        countries = self.get_list_of_countries()
-        from_date, to_date = self.get_start_and_end_date()
-        temp_df = self.data_df.set_index('country')
+        df = data_df.set_index(['date', 'country']).reindex(full_index).fillna(
+            {col: 0 for col in DataPreprocessing.count_columns})
+        
+        totals = df[['total_cases', 'total_deaths']]
+        daily = totals - totals.groupby(level='country').shift(fill_value=0)
+        df['daily_cases'] = daily.total_cases
+        df['daily_deaths'] = daily.total_deaths
+        
+        columns = ['country'] + [col for col in data_df.columns if col != 'country'] + \
+                  ['daily_cases', 'daily_deaths']
+        return df.reset_index()[columns]
+    
+    @staticmethod
+    def expand_per_day(data_df):
+        """ Reference implementation: build the data points day by day """
+        countries = sorted(data_df.country.unique().tolist())
+        from_date, to_date = data_df.date.min().date(), data_df.date.max().date()
+        temp_df = data_df.set_index('country')
 
         cases_per_day = []
         first_day = True
         
         for date in pd.date_range(from_date, to_date):
             df = temp_df[temp_df.date == date]
-            df = df.reindex(countries).fillna(
-                {
-                    'total_cases': 0, 
-                    'total_deaths': 0,
-                    'total_cases_with_travel_history_to_china':0,
-                    'total_cases_with_transmission_outside_china':0,
-                    'total_cases_with_transmission_site_under_investigation':0,
-                    'date': date
-                })
+            fill_values = {col: 0 for col in DataPreprocessing.count_columns}
+            fill_values['date'] = date
+            df = df.reindex(countries).fillna(fill_values)
 
             if first_day:
                 first_day = False
@@ -59,7 +144,148 @@ class DataPreprocessing:
             cases_per_day.append(df)
             prev_day = df
 
-        self.data_df = pd.concat(cases_per_day).reset_index()
+        return pd.concat(cases_per_day).reset_index()
+    
+    @staticmethod
+    def read_delta(delta):
+        """ The report rows of a delta given as a DataFrame, a .csv or an .xlsx file """
+        if isinstance(delta, pd.DataFrame):
+            delta_df = delta.copy()
+        elif str(delta).lower().endswith('.csv'):
+            delta_df = pd.read_csv(delta)
+        else:
+            delta_df = pd.read_excel(delta)
+        
+        delta_df.date = pd.to_datetime(delta_df.date)
+        return delta_df
+    
+    def append_data(self, delta):
+        """ Add the days of a report delta after the last stored day, without expanding the
+            whole history again. Returns the added rows of data_df (their index is their position).
+            Countries reported for the first time also get zero rows for every stored day """
+        delta_df = self.read_delta(delta)
+        if len(delta_df) == 0:
+            return self.data_df.iloc[0:0]
+        
+        # data_df is ordered by date then country: the stored days are found by binary search
+        date_values = self.data_df.date.values
+        last_date = pd.Timestamp(date_values[-1])
+        if delta_df.date.min() <= last_date:
+            raise ValueError(f'the delta must only have days after {last_date.date()}')
+        
+        # Every known country has a row on the last stored day, its totals are
+        # the reference of the first new day's daily values
+        last_day_start = date_values.searchsorted(date_values[-1], side='left')
+        last_day = self.data_df.iloc[last_day_start:].set_index('country')
+        last_day.index = last_day.index.astype(object)
+        known_countries = last_day.index.tolist()
+        new_countries = sorted(set(delta_df.country.unique()) - set(known_countries))
+        countries = sorted(known_countries + new_countries)
+        
+        previous_totals = last_day[['total_cases', 'total_deaths']].reindex(countries, fill_value=0)
+        
+        dates = pd.date_range(last_date + pd.Timedelta(days=1), delta_df.date.max())
+        full_index = pd.MultiIndex.from_product([dates, countries], names=['date', 'country'])
+        df = delta_df.set_index(['date', 'country']).reindex(full_index).fillna(
+            {col: 0 for col in self.count_columns})
+        
+        totals = df[['total_cases', 'total_deaths']]
+        shifted = totals.groupby(level='country').shift()
+        first_day = shifted.index.get_level_values('date') == dates[0]
+        shifted.loc[first_day] = previous_totals.values
+        daily = totals - shifted
+        df['daily_cases'] = daily.total_cases
+        df['daily_deaths'] = daily.total_deaths
+        
+        new_rows = [self.merge_locations(df.reset_index())]
+        if new_countries:
+            history = pd.MultiIndex.from_product([pd.date_range(date_values[0], last_date), 
+                                                  new_countries], names=['date', 'country'])
+            history_df = history.to_frame(index=False)
+            for col in self.count_columns + ['daily_cases', 'daily_deaths']:
+                history_df[col] = 0
+            new_rows.insert(0, self.merge_locations(history_df))
+        
+        new_rows = pd.concat(new_rows, ignore_index=True, sort=False)[self.data_df.columns]
+        dtypes = self.get_widened_dtypes(new_rows)
+        new_rows = new_rows.astype(dtypes)
+        stored_df = self.data_df
+        if dtypes != stored_df.dtypes.to_dict():
+            stored_df = stored_df.astype(dtypes)
+        
+        # The one copy of the stored rows, the readers keep the old data_df
+        start = len(self.data_df)
+        data_df = pd.concat([stored_df, new_rows], ignore_index=True)
+        if new_countries:
+            # Keep the rows ordered by date then country, like a full expansion
+            data_df = data_df.sort_values(['date', 'country'], kind='mergesort')
+            new_positions = np.flatnonzero(data_df.index.values >= start)
+            data_df = data_df.reset_index(drop=True)
+            new_rows = data_df.take(new_positions)
+        else:
+            new_rows.index = pd.RangeIndex(start, len(data_df))
+        
+        self.data_df = data_df
+        self.data_version = next(DataPreprocessing.versions)
+        return new_rows
+    
+    def copy(self):
+        """ A copy sharing the frames, append_data on it leaves this one unchanged """
+        return copy.copy(self)
+    
+    def get_widened_dtypes(self, new_rows):
+        """ The dtypes of data_df widened to also hold new_rows: new categories, larger counts """
+        dtypes = self.data_df.dtypes.to_dict()
+        for col, dtype in dtypes.items():
+            if dtype.name == 'category':
+                new_values = set(new_rows[col].dropna().unique()) - set(dtype.categories)
+                if new_values:
+                    dtypes[col] = pd.CategoricalDtype(sorted(set(dtype.categories) | new_values))
+            elif dtype.kind in 'iu':
+                dtypes[col] = np.promote_types(dtype, self.get_compact_dtype(new_rows[col].values))
+        return dtypes
+    
+    @staticmethod
+    def get_compact_dtype(values):
+        """ int32 when every value is a whole number in its range, else int64 or the original type.
+            Nothing narrower than int32: the time analysis sums and cumsums these columns """
+        if values.dtype.kind not in 'iuf' or len(values) == 0:
+            return values.dtype
+        if values.dtype.kind == 'f' and not (np.isfinite(values).all() and (values == np.round(values)).all()):
+            return values.dtype
+        
+        int32 = np.iinfo(np.int32)
+        if int32.min <= values.min() and values.max() <= int32.max:
+            return np.dtype(np.int32)
+        if values.dtype.kind == 'f' and np.abs(values).max() >= 2 ** 63:
+            return values.dtype
+        return np.dtype(np.int64)
+    
+    def compact_data_df(self):
+        """ Store the location columns as categoricals and the counts as integers,
+            memory_usage keeps the size of data_df in bytes before and after """
+        before = self.data_df.memory_usage(deep=True).sum()
+        
+        for col in self.location_columns:
+            values = pd.concat([self.data_df[col], self.locations_df[col]]).dropna().unique()
+            dtype = pd.CategoricalDtype(sorted(values))
+            if self.data_df[col].dtype != dtype:
+                self.data_df[col] = self.data_df[col].astype(dtype)
+            self.locations_df[col] = self.locations_df[col].astype(dtype)
+        
+        # astype always copies: the columns of a loaded snapshot already have their dtype
+        # and are left untouched, so they stay memory mapped
+        for col in AggregateCube.metric_columns:
+            dtype = self.get_compact_dtype(self.data_df[col].values)
+            if self.data_df[col].dtype != dtype:
+                self.data_df[col] = self.data_df[col].astype(dtype)
+        
+        self.memory_usage = {'before': before, 'after': self.data_df.memory_usage(deep=True).sum()}
+        return self.memory_usage
+    
+    def get_memory_report(self):
+        before, after = self.memory_usage['before'], self.memory_usage['after']
+        return f'data_df: {before / 2 ** 20:.2f} MiB -> {after / 2 ** 20:.2f} MiB ({before / after:.1f}x smaller)'
     
     def get_list_of_countries(self):
         countries = self.data_df.country.unique().tolist()
@@ -75,8 +301,10 @@ class DataPreprocessing:
         return from_date, to_date
     
     def merge_location_info(self):
-        self.data_df = self.data_df.merge(self.locations_df, how='left', 
-                                          left_on='country', right_on='country')
+        self.data_df = self.merge_locations(self.data_df)
+    
+    def merge_locations(self, data_df):
+        return data_df.merge(self.locations_df, how='left', left_on='country', right_on='country')
 
 class DataFiltering:
     """ This class is responsible for data filtering according to the dashboard use cases """
@@ -85,6 +313,93 @@ class DataFiltering:
         self.locations_df = locations_df
         self.risk_assessment_df = risk_assessment_df
         self.testing_laboratories_df = testing_laboratories_df
+        
+        self.build_date_index()
+        # loc_column -> {location: row positions}, built on first use of each level
+        self.location_index = {}
+        self.aggregate_cube = None
+    
+    def build_date_index(self):
+        """ Sort the row positions by date once, every date filter becomes a binary search """
+        self.date_values = self.data_df.date.values
+        self.is_date_sorted = bool((self.date_values[1:] >= self.date_values[:-1]).all())
+        if self.is_date_sorted:
+            self.date_order = np.arange(len(self.date_values))
+            self.sorted_dates = self.date_values
+        else:
+            self.date_order = np.argsort(self.date_values, kind='mergesort')
+            self.sorted_dates = self.date_values[self.date_order]
+    
+    def copy(self):
+        """ A copy sharing the frames and the index arrays, append_data on it leaves this one unchanged """
+        data_fltr = copy.copy(self)
+        # Readers may add a level to the index meanwhile, dict() takes it at once
+        data_fltr.location_index = {loc_column: dict(index) for loc_column, index in dict(self.location_index).items()}
+        if self.aggregate_cube is not None:
+            data_fltr.aggregate_cube = self.aggregate_cube.copy()
+        return data_fltr
+    
+    def append_data(self, data_df, new_rows):
+        """ Extend the indexes and the aggregates with the rows DataPreprocessing.append_data added.
+            When the rows were appended at the end only the new positions are indexed.
+            The indexes and the cube are changed in place, append to a copy() of shared data """
+        start = len(self.data_df)
+        self.data_df = data_df
+        if not new_rows.index.equals(pd.RangeIndex(start, len(data_df))):
+            # New countries: their rows were inserted between the stored ones, every 
+            # position moved and the country categories changed
+            self.build_date_index()
+            self.location_index = {}
+            if self.aggregate_cube is not None:
+                self.aggregate_cube = AggregateCube(data_df)
+            return
+        
+        self.extend_date_index(start)
+        for loc_column, index in self.location_index.items():
+            for loc_value, positions in new_rows.groupby(loc_column, observed=True).indices.items():
+                # The chunks are only joined when the location is looked up
+                chunks = index.get(loc_value, [])
+                index[loc_value] = (chunks if isinstance(chunks, list) else [chunks]) + [positions + start]
+        
+        if self.aggregate_cube is not None:
+            self.aggregate_cube.append_data(new_rows)
+    
+    def extend_date_index(self, start):
+        new_dates = self.data_df.date.values[start:]
+        self.date_values = self.data_df.date.values
+        # The appended days all come after the stored ones
+        self.is_date_sorted = self.is_date_sorted and bool((new_dates[1:] >= new_dates[:-1]).all())
+        if self.is_date_sorted:
+            self.date_order = np.arange(len(self.date_values))
+            self.sorted_dates = self.date_values
+        else:
+            self.date_order = np.concatenate([self.date_order, 
+                                              start + np.argsort(new_dates, kind='mergesort')])
+            self.sorted_dates = self.date_values[self.date_order]
+    
+    def get_location_positions(self, loc_column, loc_value):
+        if loc_column not in self.location_index:
+            self.location_index[loc_column] = self.data_df.groupby(loc_column, observed=True).indices
+        index = self.location_index[loc_column]
+        positions = index.get(loc_value, np.array([], dtype=np.int64))
+        if isinstance(positions, list):
+            # Position chunks of appended rows, see append_data
+            positions = index[loc_value] = np.concatenate(positions)
+        return positions
+    
+    def get_date_positions(self, date, until=False):
+        """ Row positions (in frame order) of date, or of every date up to it """
+        date = pd.Timestamp(date).to_datetime64()
+        stop = self.sorted_dates.searchsorted(date, side='right')
+        start = 0 if until else self.sorted_dates.searchsorted(date, side='left')
+        if self.is_date_sorted:
+            return np.arange(start, stop)
+        return np.sort(self.date_order[start:stop])
+    
+    def get_aggregate_cube(self):
+        if self.aggregate_cube is None:
+            self.aggregate_cube = AggregateCube(self.data_df)
+        return self.aggregate_cube
     
     def get_data_df(self):
         return self.data_df
@@ -96,24 +411,26 @@ class DataFiltering:
         return self.data_df.set_index('country')
     
     def get_specific_date_stats(self, date):
-        return self.data_df[self.data_df.date == pd.Timestamp(date)]
+        return self.data_df.take(self.get_date_positions(date))
     
     def get_until_specific_date_stats(self, date):
-        return self.data_df[self.data_df.date <= pd.Timestamp(date)]
+        return self.data_df.take(self.get_date_positions(date, until=True))
     
     def get_specific_location_stats(self, loc_column, loc_value):
-        return self.data_df[self.data_df[loc_column] == loc_value]
+        return self.data_df.take(self.get_location_positions(loc_column, loc_value))
     
     def get_specific_date_location_stats(self, date, loc_column, loc_value):
-        return self.data_df[(self.data_df[loc_column] == loc_value) & 
-                            (self.data_df.date == pd.Timestamp(date))]
+        positions = self.get_location_positions(loc_column, loc_value)
+        positions = positions[self.date_values[positions] == pd.Timestamp(date).to_datetime64()]
+        return self.data_df.take(positions)
     
     def get_until_date_location_stats(self, date, loc_column, loc_value):
-        return self.data_df[(self.data_df[loc_column] == loc_value) & 
-                            (self.data_df.date <= pd.Timestamp(date))]
+        positions = self.get_location_positions(loc_column, loc_value)
+        positions = positions[self.date_values[positions] <= pd.Timestamp(date).to_datetime64()]
+        return self.data_df.take(positions)
 
     def get_specific_date_level_stats(self,loc_column):
-        return self.data_df.groupby([loc_column]).sum()
+        return self.data_df.groupby([loc_column], observed=True).sum()
 
     def get_locations_df(self):
         return self.locations_df
@@ -123,3 +440,226 @@ class DataFiltering:
     
     def get_latest_risk_assessment(self):
         return self.risk_assessment_df.iloc[-3:]
+
+
+class AggregateCube:
+    """ This class holds the sums of every metric by (level, location, date) and the
+        infected countries per date, so the analysis answers by lookup instead of re-filtering """
+    
+    levels = ['country', 'region', 'continent']
+    metric_columns = DataPreprocessing.count_columns + ['daily_cases', 'daily_deaths']
+    
+    def __init__(self, data_df):
+        self.global_sums = data_df.groupby('date')[self.metric_columns].sum()
+        # observed=True keeps the locations in order of appearance, sort them like the object columns are
+        self.level_sums = {level: data_df.groupby([level, 'date'], observed=True)[self.metric_columns].sum().sort_index()
+                           for level in self.levels}
+        
+        self.infected = self.get_infected(data_df)
+        
+        self.level_countries = {}
+        self.country_location = {}
+        for level in self.levels:
+            pairs = self.get_location_pairs(data_df, level)
+            self.level_countries[level] = pairs.groupby('location').country.apply(list).to_dict()
+            self.country_location[level] = pairs.set_index('country').location.rename(level)
+        
+        self.first_dates = {level: self.get_first_dates(data_df, level) for level in self.levels}
+    
+    def copy(self):
+        """ A copy sharing the frames, append_data on it leaves this one unchanged """
+        data_cube = copy.copy(self)
+        data_cube.level_sums = dict(self.level_sums)
+        data_cube.level_countries = {level: dict(locations) for level, locations in self.level_countries.items()}
+        data_cube.country_location = dict(self.country_location)
+        data_cube.first_dates = dict(self.first_dates)
+        return data_cube
+    
+    def append_data(self, new_rows):
+        """ Add the rows appended to data_df, only the sums of their dates are computed.
+            The rows must not bring new country categories, DataFiltering rebuilds the cube then """
+        # New countries bring zero rows for the stored dates, so the new sums may overlap the stored ones
+        later = new_rows.date.min() > self.global_sums.index.max()
+        self.global_sums = self.add_sums(self.global_sums, new_rows.groupby('date')[self.metric_columns].sum(), later)
+        for level in self.levels:
+            new_sums = new_rows.groupby([level, 'date'], observed=True)[self.metric_columns].sum()
+            self.level_sums[level] = self.add_sums(self.level_sums[level], new_sums, later)
+        
+        infected = self.get_infected(new_rows)
+        if infected.index.min() > self.infected.index.max() and infected.columns.isin(self.infected.columns).all():
+            # Only new days of known countries: the stored days are copied once instead of aligned
+            self.infected = pd.concat([self.infected, infected.reindex(columns=self.infected.columns, fill_value=False)])
+        else:
+            dates = self.infected.index.union(infected.index)
+            countries = self.infected.columns.union(infected.columns)
+            self.infected = self.infected.reindex(index=dates, columns=countries, fill_value=False) | \
+                infected.reindex(index=dates, columns=countries, fill_value=False)
+        
+        for level in self.levels:
+            pairs = self.get_location_pairs(new_rows, level)
+            pairs = pairs[~pairs.country.isin(self.country_location[level].index)]
+            if len(pairs) == 0:
+                continue
+            for location_name, countries in pairs.groupby('location').country.apply(list).items():
+                self.level_countries[level][location_name] = sorted(
+                    self.level_countries[level].get(location_name, []) + countries)
+            self.country_location[level] = pd.concat([
+                self.country_location[level], pairs.set_index('country').location.rename(level)]).sort_index()
+        
+        for level in self.levels:
+            first_dates = pd.concat([self.first_dates[level], self.get_first_dates(new_rows, level)])
+            self.first_dates[level] = first_dates.groupby(level=0).min()
+    
+    @staticmethod
+    def get_infected(data_df):
+        """ date x country, True once the country has cases """
+        infected = data_df.pivot(index='date', columns='country', values='total_cases').fillna(0) != 0
+        infected.columns = pd.Index(infected.columns.tolist(), name='country')
+        return infected
+    
+    @staticmethod
+    def get_location_pairs(data_df, level):
+        """ The distinct (location, country) pairs of a level as plain strings.
+            The level goes to its own column, at the country level both columns are the country """
+        pairs = pd.DataFrame({'location': data_df[level], 'country': data_df['country']})
+        return pairs.dropna().drop_duplicates().astype(object)
+    
+    @staticmethod
+    def add_sums(sums, new_sums, later=False):
+        """ sums + new_sums, later when every new date comes after the stored ones:
+            the new rows are then appended instead of aligned with the whole history """
+        if later:
+            return pd.concat([sums, new_sums.astype(sums.dtypes.to_dict())]).sort_index(kind='mergesort')
+        return sums.add(new_sums, fill_value=0).astype(sums.dtypes.to_dict())
+    
+    @staticmethod
+    def get_first_dates(data_df, level):
+        """ First date with cases and first date with deaths of every location of a level """
+        first_dates = pd.DataFrame({
+            level: data_df[level],
+            'total_cases': data_df.date.where(data_df.total_cases > 0),
+            'total_deaths': data_df.date.where(data_df.total_deaths > 0)
+        })
+        return first_dates.groupby(level, observed=True).min().sort_index()
+    
+    def get_first_date(self, selected_level, location_name, column, to_date=None):
+        """ The first date the column of the location is above 0, None if it never was (until to_date) """
+        first_dates = self.first_dates[selected_level]
+        if location_name not in first_dates.index:
+            return None
+        first_date = first_dates.at[location_name, column]
+        if pd.isnull(first_date) or (to_date is not None and first_date > pd.Timestamp(to_date)):
+            return None
+        return first_date
+    
+    def get_sums(self, selected_level=None, location_name=None, to_date=None):
+        """ Per-date sums of the metric columns for a location (the whole world when selected_level is None) """
+        if selected_level is None:
+            df = self.global_sums
+        else:
+            try:
+                df = self.level_sums[selected_level].xs(location_name, level=selected_level)
+            except KeyError:
+                df = self.global_sums.iloc[0:0]
+                
+        if to_date is not None:
+            df = df.loc[:pd.Timestamp(to_date)]
+        return df
+    
+    def get_totals(self, date, selected_level=None, location_name=None):
+        """ Metric sums of one date, zeros when the location has no data point on it """
+        df = self.get_sums(selected_level, location_name)
+        return df.reindex([pd.Timestamp(date)]).fillna(0).iloc[0]
+    
+    def get_infected_countries(self, rate='d', selected_level=None, location_name=None, to_date=None):
+        """ Number of distinct infected countries per period, between the first and last infected dates """
+        infected = self.infected
+        if selected_level is not None:
+            infected = infected[self.level_countries[selected_level].get(location_name, [])]
+        if to_date is not None:
+            infected = infected.loc[:pd.Timestamp(to_date)]
+        
+        infected_dates = infected.index[infected.any(axis=1).values]
+        if len(infected_dates) == 0:
+            return pd.Series([], index=pd.DatetimeIndex([], name='date'), name='country', dtype=np.int64)
+        
+        infected = infected.loc[infected_dates[0]:infected_dates[-1]]
+        if rate == 'd':
+            result = infected.sum(axis=1)
+        else:
+            result = infected.astype(np.int64).resample(rate).max().sum(axis=1)
+        return result.rename('country')
+    
+    def count_infected_locations(self, date, selected_level):
+        """ Number of distinct locations of a level with at least one infected country on date """
+        infected = self.infected.reindex([pd.Timestamp(date)]).fillna(False).iloc[0]
+        countries = infected.index[infected.values.astype(bool)]
+        return self.country_location[selected_level].reindex(countries).nunique()
+
+
+class DataContext:
+    """ This class holds the process-wide preprocessed and filtered data.
+        The data is loaded once and reused by every caller until invalidate() is called """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Held for a whole append so that appends see each other, get() only waits for the swap
+        self.append_lock = threading.Lock()
+        self.state = None
+        self.version = 0
+        self.local = threading.local()
+    
+    def get(self):
+        """ Return (DataPreprocessing, DataFiltering), loading them on first use """
+        local_state = getattr(self.local, 'state', None)
+        if local_state is not None:
+            return local_state
+        with self.lock:
+            if self.state is None:
+                self.state = self.load()
+                self.version += 1
+            return self.state
+    
+    def load(self):
+        with span('data load'):
+            data_process = DataPreprocessing()
+            with span('filter indexes'):
+                data_fltr = DataFiltering(data_process.data_df, data_process.locations_df, 
+                                          data_process.risk_assessment_df, data_process.testing_laboratories_df)
+            with span('aggregate cube'):
+                data_fltr.get_aggregate_cube()
+        return data_process, data_fltr
+    
+    def append(self, delta):
+        """ Add a report delta with the new days to the loaded data, see DataPreprocessing.append_data.
+            The new data is built on copies and swapped in, callers still holding the old one keep it unchanged """
+        with self.append_lock, span('append data'):
+            data_process, data_fltr = self.get()
+            data_process, data_fltr = data_process.copy(), data_fltr.copy()
+            new_rows = data_process.append_data(delta)
+            data_fltr.append_data(data_process.data_df, new_rows)
+            with self.lock:
+                self.state = (data_process, data_fltr)
+                self.version += 1
+        return new_rows
+    
+    def set(self, data_process, data_fltr):
+        """ Serve the given data instead of loading the workbooks, e.g. a generated dataset """
+        with self.lock:
+            self.state = (data_process, data_fltr)
+            self.version += 1
+    
+    @contextlib.contextmanager
+    def using(self, data_process, data_fltr):
+        """ get() returns the given data in this thread within the block, 
+            e.g. to render a new version before it is set() for everyone """
+        self.local.state = (data_process, data_fltr)
+        try:
+            yield
+        finally:
+            self.local.state = None
+    
+    def invalidate(self):
+        with self.lock:
+            self.state = None
+
+data_context = DataContext()
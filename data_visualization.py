@@ -1,20 +1,40 @@
-from data_preprocessing import DataPreprocessing , DataFiltering
+from data_preprocessing import DataPreprocessing , DataFiltering, data_context
+from data_cache import write_atomically
+from instrumentation import collect, span
 from data_analysis import DataSummary, LocationProfileSummary, AnalysisFacad, DataTimeAnalysis,    DataLocationLevelAnalysis, LocationProfileAnalysisFacad, DataCountryAnalysis
+import data_metrics
 
 from abc import ABCMeta, abstractmethod
 from bokeh.models.widgets import Tabs, Panel
-from bokeh.plotting import figure, show, output_notebook, reset_output, output_file, save
-from bokeh.models import ColumnDataSource, HoverTool, LogColorMapper, ColorBar, BasicTicker, Label
+from bokeh.plotting import figure, show, output_notebook, reset_output
+from bokeh.models import ColumnDataSource, HoverTool, LogColorMapper, ColorBar, BasicTicker, Label, GlyphRenderer, CDSView
+from bokeh.models import CustomJS, Div, Plot, Axis, Grid
+from bokeh.model import Model
+from bokeh.embed import json_item, file_html
+from bokeh.resources import CDN
+from bokeh.models.expressions import Stack
+from bokeh.core.json_encoder import serialize_json
 from bokeh.transform import transform
 from bokeh.tile_providers import get_provider, Vendors
 from bokeh.layouts import column, row
 from bokeh.models.tickers import FixedTicker
 from datetime import datetime, date, timedelta
 import numpy as np
-from bs4 import BeautifulSoup
-import codecs
+from urllib.parse import urlencode
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import re
 import pandas as pd
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 import warnings
 warnings.filterwarnings("ignore")
 
@@ -96,6 +116,9 @@ class LineGraphParams:
     circle_line_width = 3
     circle_size = 8
     circle_fill_color = 'white'
+    # Longer date series are drawn from the minimum and maximum rows of buckets of days, 0 draws every day.
+    # A series of n columns keeps at least 2 + 2 * n rows, see data_metrics.get_min_max_positions
+    max_points = int(os.environ.get('CORONA_BOARD_MAX_POINTS', '300')) or None
 
 class BarParams:
     bar_width = 0.5
@@ -106,6 +129,8 @@ class BarParams:
     color = ['#002952', '#006ab8', '#97a3ff']
     legend_font_size = '8pt'
     tools = "pan,reset,save,hover"
+    # The World Wide bar graphs show the top_k countries and an 'Others' bar, 0 shows every country
+    top_k = int(os.environ.get('CORONA_BOARD_BAR_TOP_K', '30')) or None
     
 class MapParams:
     plot_width = 1200
@@ -118,6 +143,62 @@ class MapParams:
     long = 'merc_long'
     tools = "pan,reset,save,box_zoom"
 
+class RenderParams:
+    # Prune, share and compact the ColumnDataSources and share the tickers before saving the dashboard.
+    # On data/ the page is 17% smaller and renders faster, the smaller document serializes faster
+    optimize_document = os.environ.get('CORONA_BOARD_OPTIMIZE_DOCUMENT', '1') == '1'
+    
+    # Ship only the active tab, the others are fetched from tab_url when they are opened
+    lazy_tabs = os.environ.get('CORONA_BOARD_LAZY_TABS', '0') == '1'
+    tab_url = 'tab'
+    
+    lazy_tab_js = """
+    const url = urls[cb_obj.active];
+    const target = targets[cb_obj.active];
+    window.corona_board_loaded_tabs = window.corona_board_loaded_tabs || {};
+    if (!url || window.corona_board_loaded_tabs[target]) {
+        return;
+    }
+    window.corona_board_loaded_tabs[target] = true;
+    fetch(url)
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error(response.status);
+            }
+            return response.json();
+        })
+        .then(function(item) {
+            // Wait for the panel to be displayed before embedding into it
+            setTimeout(function() { Bokeh.embed.embed_item(item, target); }, 0);
+        })
+        .catch(function() { window.corona_board_loaded_tabs[target] = false; });
+    """
+    
+    # Title of the saved pages
+    title = 'Corona Board'
+    
+    # Style of the tabs, added to every saved page
+    page_template = """
+    {% block postamble %}
+    <style>
+    .bk-root .bk-tab {
+    font-style: normal;
+    font-size: medium;
+    }
+
+
+    .bk-root .bk-tabs-header .bk-tab.bk-active{
+    background-color: #2F4F4F;
+    color: white;
+    font-style: normal;
+    font-weight: bold;
+    font-size: medium;
+    }
+
+    </style>
+    {% endblock %}
+    """
+
 class Graph(metaclass=ABCMeta):
     
     periods_names = {
@@ -128,7 +209,7 @@ class Graph(metaclass=ABCMeta):
     
     def __init__(self, data_df):
         
-        self.data_df = data_df
+        self.data_df = Utilities.decategorize(data_df)
         self.data_df = self.data_df.fillna(0)
         self.source = ColumnDataSource(self.data_df)
         self.figure = None
@@ -154,26 +235,45 @@ class Graph(metaclass=ABCMeta):
     
 class Utilities:
     @staticmethod
-    def cases_deaths_to_log(total_cases_deaths, fatality_rate, selected_level):
-        data_df = total_cases_deaths.merge(fatality_rate, on='country')
+    def decategorize(df):
+        """ df with its categorical columns as plain values, fillna and ColumnDataSource need them """
+        columns = {col: object for col, dtype in df.dtypes.items() if dtype.name == 'category'}
+        if len(columns) == 0:
+            return df
+        return df.astype(columns)
+    
+    @staticmethod
+    def cases_deaths_to_log(total_cases_deaths, selected_level):
+        data_df = total_cases_deaths.copy()
+        # Computed from the counts, the fatality rate frame may hold other countries than the top cases
+        fatality_rate = data_metrics.get_percentage(data_df.total_deaths.values, data_df.total_cases.values)
+        data_df['fatality_rate'] = np.where(np.isnan(fatality_rate), 0, fatality_rate)
 
-        data_df['total_cases_log'] = data_df.total_cases.apply(
-            lambda x: np.log(x + 0.1) * 50 if x != 0 else 0)
+        data_df['total_cases_log'] = data_metrics.log_scale(data_df.total_cases.values)
         
-        data_df['total_deaths_log'] = data_df.apply(
-            lambda x: (x['total_cases_log'] * x['fatality_rate']) / 100, axis=1)
+        data_df['total_deaths_log'] = (data_df['total_cases_log'] * data_df['fatality_rate']) / 100
 
         data_df['total_cases_log'] = data_df['total_cases_log'] - data_df['total_deaths_log']
         
         return data_df
     
     
+    @staticmethod
+    def downsample(df, columns, max_points = None):
+        """ The rows of df kept by the min/max bucketing of the columns, so the line keeps its peaks
+            and the hover tool shows true values, see data_metrics.get_min_max_positions """
+        if max_points is None:
+            max_points = LineGraphParams.max_points
+        if max_points is None or len(df) <= max_points:
+            return df
+        return df.iloc[data_metrics.get_min_max_positions([df[col].values for col in columns], max_points)]
+    
     @staticmethod
     def create_progress_df(df, to_be_dropped, columns_names):
         df = df.drop(columns = to_be_dropped)
         
         df.columns = columns_names
-        df['accumelator'] = df[[columns_names[len(columns_names) - 1]]].apply(lambda r: 100 - r)
+        df['accumelator'] = 100 - df[columns_names[len(columns_names) - 1]]
         return df
     
     
@@ -197,7 +297,7 @@ class NumCountriesDateGraph(Graph):
                                                     location_name=None)
             data_df['country'] = data_df.country.apply(lambda x: 0)
             
-        super().__init__(data_df)
+        super().__init__(Utilities.downsample(data_df, ['country']))
         self.rate = rate
         
     @property
@@ -261,7 +361,8 @@ class TotalDailyDeathsDateGraph(Graph):
         self.time_analyser = time_analyser
         self.data_df = self.time_analyser.daily_and_total_deaths(rate,'daily_deaths', 'total_deaths',
                                                        self.selected_level,self.location_name)
-        super().__init__(self.data_df)
+        daily_col = 'monthly_deaths' if rate == 'm' else 'daily_deaths'
+        super().__init__(Utilities.downsample(self.data_df, ['total_deaths', daily_col]))
         self.rate = rate
         
     @property
@@ -356,7 +457,8 @@ class TotalDailyCasesDateGraph(Graph):
         self.location_name=location_name
         data_df = time_analyser.daily_and_total_cases(rate,'daily_cases', 'total_cases',
                                                       self.selected_level,self.location_name)
-        super().__init__(data_df)
+        daily_col = 'monthly_cases' if rate == 'm' else 'daily_cases'
+        super().__init__(Utilities.downsample(data_df, ['total_cases', daily_col]))
         self.rate = rate
         
     @property
@@ -445,7 +547,7 @@ class FatalityRateDateGraph(Graph):
     def __init__(self, time_analyser, rate, selected_level = None, location_name = None):
         data_df = time_analyser.fatality_rate(rate, 'daily_deaths', 'daily_cases',
                                               selected_level, location_name)
-        super().__init__(data_df)
+        super().__init__(Utilities.downsample(data_df, ['fatal_rate']))
         self.rate = rate
         
     @property
@@ -599,14 +701,13 @@ class OutbreakRateBargraph(Graph):
 
 class CasesDeathsBargraph(Graph):
     
-    def __init__(self, total_cases_deaths, fatality_rate, bar_height, selected_level='country', selected_location=None):
+    def __init__(self, total_cases_deaths, bar_height, selected_level='country', selected_location=None):
         self.bar_height = bar_height
         self.selected_level = selected_level
         
         total_cases_deaths = total_cases_deaths.loc[:,~total_cases_deaths.columns.duplicated()]
-        fatality_rate = fatality_rate.loc[:,~fatality_rate.columns.duplicated()]
     
-        super().__init__(Utilities.cases_deaths_to_log(total_cases_deaths, fatality_rate, selected_level))
+        super().__init__(Utilities.cases_deaths_to_log(total_cases_deaths, selected_level))
 
     @property
     def title(self):
@@ -644,11 +745,10 @@ class CountriesMap(Graph):
     def __init__(self, countries_analyser, level = None, location = None):
         if level is not None:
             countries_analyser = Utilities.get_level_data(countries_analyser, level, location)
-
+        countries_analyser = Utilities.decategorize(countries_analyser)
         
-        countries_analyser['circle_size'] = countries_analyser['total_cases'].apply(
-            lambda x: 0 if x == 0\
-            else (MapParams.plot_scale(x + 0.5) * MapParams.plot_scale_factor))
+        countries_analyser['circle_size'] = data_metrics.marker_size(
+            countries_analyser['total_cases'].values, MapParams.plot_scale, MapParams.plot_scale_factor)
 
         self.sources = {
             'cases': (ColumnDataSource(countries_analyser[countries_analyser.total_deaths == 0]), 
@@ -713,15 +813,10 @@ class Summary:
     @staticmethod
     def render_item(text, x_offset, y_offset, color, width, height, font_size):
         
-        f = figure(plot_width=width, plot_height=height)
+        # No axes, grids or tools: the card only shows its labels
+        f = figure(plot_width=width, plot_height=height, tools='', x_axis_type=None, y_axis_type=None)
         
         """Adjusting Figure Attributes"""
-        f.xaxis.visible  = False
-        f.yaxis.visible  = False
-
-        f.xgrid.visible = False
-        f.ygrid.visible = False
-
         f.toolbar.logo = None                          # remove toolbar
         f.toolbar_location = None                      # remove toolbar
         
@@ -935,30 +1030,193 @@ class Tab(Graph):
             [self.fatality_rate_per_country.figure, self.out_break_rate.figure]
         ])
 
+class DocumentOptimizer:
+    """ Shrinks the serialized dashboard: keeps only the source columns a glyph or a tooltip uses,
+        shares identical sources, tickers and tick formatters between figures and tabs and sends 
+        numbers as typed arrays. The models of the document are collected in a single pass """
+    
+    # @column, @{column name} and @$name references of the tooltips
+    tooltip_field = re.compile(r'@\{([^}]+)\}|@(\$name|\w+)')
+    int32_range = (np.iinfo(np.int32).min, np.iinfo(np.int32).max)
+    
+    def __init__(self):
+        self.shared_sources = {}
+        self.shared_models = {}
+        self.report = []
+    
+    @staticmethod
+    def get_size(model):
+        """ Size in bytes of the JSON of model and every model it references """
+        models = [{'type': m.__view_model__, 'id': m.id, 'attributes': m.to_json(include_defaults=False)}
+                  for m in model.references()]
+        return len(serialize_json(models))
+    
+    @staticmethod
+    def get_glyph_fields(renderer):
+        fields = set()
+        for glyph in [renderer.glyph, renderer.hover_glyph, renderer.muted_glyph]:
+            if glyph is None:
+                continue
+            for value in glyph.properties_with_values(include_defaults=False).values():
+                if not isinstance(value, dict):
+                    continue
+                if 'field' in value:
+                    fields.add(value['field'])
+                if isinstance(value.get('expr'), Stack):
+                    fields.update(value['expr'].fields)
+        return fields
+    
+    @classmethod
+    def get_tooltip_fields(cls, hover, renderers):
+        tooltips = hover.tooltips
+        if not isinstance(tooltips, str):
+            tooltips = ' '.join(value for _, value in (tooltips or []))
+        
+        fields = set()
+        for braced, plain in cls.tooltip_field.findall(tooltips):
+            if plain == '$name':
+                fields.update(r.name for r in renderers if r.name)
+            else:
+                fields.add(braced or plain)
+        return fields
+    
+    def get_used_fields(self, models):
+        """ source id -> columns its renderers and their tooltips reference """
+        used_fields = {}
+        for renderer in models[GlyphRenderer]:
+            used_fields.setdefault(renderer.data_source.id, set()).update(self.get_glyph_fields(renderer))
+        
+        # The plot of every hover tool, the toolbars list the same tools
+        hover_plots = {tool.id: plot for plot in models[Plot] for tool in plot.tools}
+        for hover in models[HoverTool]:
+            renderers = hover.renderers
+            if renderers == 'auto' or not renderers:
+                plot = hover_plots[hover.id]
+                renderers = [r for r in plot.renderers if isinstance(r, GlyphRenderer)]
+            fields = self.get_tooltip_fields(hover, renderers)
+            for renderer in renderers:
+                used_fields[renderer.data_source.id].update(fields)
+        return used_fields
+    
+    @classmethod
+    def compact_column(cls, values):
+        """ Integer valued numbers become int32 so BokehJS receives them as a typed array """
+        if not isinstance(values, np.ndarray) or values.dtype.kind not in 'if' or values.dtype == np.int32:
+            return values
+        if len(values) == 0 or not np.isfinite(values).all():
+            return values
+        if values.min() < cls.int32_range[0] or values.max() > cls.int32_range[1]:
+            return values
+        if values.dtype.kind == 'f' and not (values == np.round(values)).all():
+            return values
+        return values.astype(np.int32)
+    
+    @staticmethod
+    def get_source_key(source):
+        key = hashlib.sha1()
+        for name in sorted(source.data):
+            values = np.asarray(source.data[name])
+            key.update(name.encode())
+            key.update(str(values.dtype).encode())
+            if values.dtype.kind in 'biuf':
+                key.update(values.tobytes())
+            else:
+                key.update(repr(values.tolist()).encode())
+        return key.hexdigest()
+    
+    @classmethod
+    def get_model_key(cls, model):
+        """ The type and attributes of model and of the models it references, without their ids """
+        def plain(value):
+            if isinstance(value, Model):
+                return cls.get_model_key(value)
+            if isinstance(value, (list, tuple)):
+                return [plain(v) for v in value]
+            return value
+        values = model.properties_with_values(include_defaults=False)
+        return repr((model.__view_model__, sorted((name, plain(value)) for name, value in values.items())))
+    
+    @staticmethod
+    def collect_models(model):
+        """ type -> the models of that type model references, in one pass over the document """
+        models = {model_type: [] for model_type in (GlyphRenderer, Plot, HoverTool, Axis, Grid)}
+        for m in model.references():
+            for model_type, found in models.items():
+                if isinstance(m, model_type):
+                    found.append(m)
+        return models
+    
+    def share_axis_models(self, models):
+        """ Every axis with an equal ticker or formatter, e.g. each date axis with its twelve
+            sub-tickers, gets the same one. The grids follow the ticker of their axis """
+        tickers = {}
+        for axis in models[Axis]:
+            for name in ('ticker', 'formatter'):
+                value = getattr(axis, name)
+                shared = self.shared_models.setdefault(self.get_model_key(value), value)
+                if shared is not value:
+                    tickers[value.id] = shared
+                    setattr(axis, name, shared)
+        for grid in models[Grid]:
+            if grid.ticker is not None and grid.ticker.id in tickers:
+                grid.ticker = tickers[grid.ticker.id]
+    
+    def optimize(self, model):
+        """ Optimize every source, ticker and tick formatter of model in place """
+        models = self.collect_models(model)
+        used_fields = self.get_used_fields(models)
+        for renderer in models[GlyphRenderer]:
+            source = renderer.data_source
+            if source.id in used_fields:
+                fields = used_fields.pop(source.id)
+                source.data = {name: self.compact_column(values) 
+                               for name, values in source.data.items() if name in fields}
+            
+            key = self.get_source_key(source)
+            shared_source = self.shared_sources.setdefault(key, source)
+            if shared_source is not source:
+                renderer.data_source = shared_source
+                renderer.view = CDSView(source=shared_source)
+        self.share_axis_models(models)
+    
+    def optimize_tabs(self, tabs, report = False):
+        """ Optimize every panel of tabs, sharing sources across them, and optionally 
+            record the JSON size of each panel before and after """
+        sizes_before = [self.get_size(panel.child) for panel in tabs.tabs] if report else None
+        self.optimize(tabs)
+        if report:
+            self.report += [(panel.title, size_before, self.get_size(panel.child))
+                            for panel, size_before in zip(tabs.tabs, sizes_before)]
+        return self.report
+    
+    def get_report(self):
+        lines = ['tab | bytes before | bytes after']
+        for title, size_before, size_after in self.report:
+            lines.append(f'{title} | {size_before} | {size_after}')
+        return '\n'.join(lines)
+
 def get_max_date():
-    data_process = DataPreprocessing()
+    data_process, _ = data_context.get()
     return data_process.data_df.date.max().date()
 
 def get_all_continent(to_date):
-    data_process = DataPreprocessing()
-    data_fltr = DataFiltering(data_process.data_df, data_process.locations_df, 
-              data_process.risk_assessment_df, data_process.testing_laboratories_df)
+    data_process, data_fltr = data_context.get()
 
     ca = DataCountryAnalysis(data_process, data_fltr, to_date=to_date).get_countries_data()
 
     return list(ca.continent.unique())
 
-def set_up(to_date = None, selected_level = 'country', location_name = 'China'):
-    data_process = DataPreprocessing()
-    data_fltr = DataFiltering(data_process.data_df, data_process.locations_df, 
-              data_process.risk_assessment_df, data_process.testing_laboratories_df)
+def set_up(to_date = None, selected_level = 'country', location_name = 'China', top_k = None):
+    """ The analysis results of a tab, from the memoized facades. top_k is for the World Wide bar graphs,
+        a profile looks its location up in the full level frames """
+    data_process, data_fltr = data_context.get()
 
     time_analyser = DataTimeAnalysis(data_process, data_fltr, to_date=to_date)
 
     lc = DataLocationLevelAnalysis(data_process, data_fltr, to_date=to_date)
 
     af = AnalysisFacad(lc, time_analyser)
-    world_wide_stats =  af.get_visualization_data()
+    world_wide_stats =  af.get_visualization_data(top_k=top_k)
 
     ca = DataCountryAnalysis(data_process, data_fltr, to_date=to_date).get_countries_data()
 
@@ -971,7 +1229,7 @@ def set_up(to_date = None, selected_level = 'country', location_name = 'China'):
     return time_analyser, world_wide_stats, world_wide_summary, location_summary, ca
 
 def get_world_wide_layout(to_date = None):
-    time_analyser, world_wide_stats, world_wide_summary, _, ca = set_up(to_date=to_date)
+    time_analyser, world_wide_stats, world_wide_summary, _, ca = set_up(to_date=to_date, top_k=BarParams.top_k)
     # World wide summary
     world_wide_summ = WWSummary(world_wide_summary)
 
@@ -1012,8 +1270,7 @@ def get_world_wide_layout(to_date = None):
     obr = OutbreakRateBargraph(world_wide_stats['country_outbreak_ratio'], BarParams.bar_width)
 
     # Total cases and deaths
-    cd = CasesDeathsBargraph(world_wide_stats['country_total_cases_death'], 
-                   world_wide_stats['country_fatality_rate'], BarParams.bar_width)
+    cd = CasesDeathsBargraph(world_wide_stats['country_total_cases_death'], BarParams.bar_width)
 
     # Create World wide layout
     wwt = Tab(world_wide_summ, cm, ncv_d, ncv_m, tdd_d, tdd_m,
@@ -1077,7 +1334,7 @@ def get_location_profile_layout(to_date = None, selected_level = 'country', loca
     # Total cases and deaths
     cases_deaths_df = world_wide_stats[f'{selected_level.lower()}_total_cases_death']
     cases_deaths_df = cases_deaths_df[cases_deaths_df[selected_level.lower()] == location_name]
-    cd = CasesDeathsBargraph(cases_deaths_df, fatality_df, BarParams.single_bar_width, 
+    cd = CasesDeathsBargraph(cases_deaths_df, BarParams.single_bar_width, 
                              selected_level = selected_level.lower(), selected_location = location_name)
 
 
@@ -1087,57 +1344,147 @@ def get_location_profile_layout(to_date = None, selected_level = 'country', loca
     location_tap.render()
     return location_tap
 
-def render_dashboard(active_tab=0, file_name = 'template/dash_board.html'):
-    def update_html_element(title, file_name):
-        with codecs.open(file_name, 'r') as f:
-            layout = f.read()
-
-        # Change the title of the page
-        soup = BeautifulSoup(layout, 'lxml')
-        tag = soup.title
-        tag.string = title
-
-        # Center the dashboard
-        body = soup.find("div", {"class": "bk-root"})['align'] = 'center'
-
-        html = soup.prettify("utf-8")
-        with open(file_name, 'wb') as f:
-            f.write(html)
-    
-    world_wide = get_world_wide_layout(to_date=get_max_date())
-
-    cont = get_all_continent(get_max_date())
-    continent_tabs = [Panel(child=get_location_profile_layout(to_date=get_max_date(), 
-        selected_level='continent', 
-        location_name=c).figure, title=c.title())
-    for c in cont]
-
-    all_tabs = [Panel(child=world_wide.figure, title="World Wide")] + continent_tabs
-    dash_board = Tabs(tabs=all_tabs, active=active_tab)
+def get_tab_layout(to_date = None, selected_level = None, location_name = None):
+    """ The World Wide tab when selected_level is None, else the profile of the location """
+    with span('tab layout', tab=location_name or 'World Wide'):
+        if selected_level is None:
+            return get_world_wide_layout(to_date=to_date)
+        return get_location_profile_layout(to_date=to_date, selected_level=selected_level, 
+                                           location_name=location_name)
+
+def get_location_slug(location_name):
+    return re.sub(r'\W+', '-', location_name).lower()
+
+def get_location_slugs(location_names):
+    """ location name -> slug, unique among location_names: a slug already taken gets a -2, -3, ... suffix,
+        given in the order of the sorted names """
+    slugs = {}
+    taken = set()
+    for location_name in sorted(location_names):
+        slug = base = get_location_slug(location_name)
+        suffix = 2
+        while slug in taken:
+            slug = f'{base}-{suffix}'
+            suffix += 1
+        taken.add(slug)
+        slugs[location_name] = slug
+    return slugs
+
+def get_tab_target(selected_level = None, location_name = None):
+    if selected_level is None:
+        return 'tab-world-wide'
+    return 'tab-{}-{}'.format(selected_level, get_location_slug(location_name))
+
+def get_tab_url(selected_level = None, location_name = None):
+    if selected_level is None:
+        return RenderParams.tab_url
+    return RenderParams.tab_url + '?' + urlencode({'level': selected_level, 'location': location_name})
+
+def get_tab_item(selected_level = None, location_name = None, to_date = None):
+    """ One tab as a serialized Bokeh JSON item, embedded by the page when the tab is opened.
+        Raises KeyError for an unknown level or location """
+    if selected_level is not None:
+        _, data_fltr = data_context.get()
+        if location_name not in data_fltr.get_aggregate_cube().level_countries[selected_level]:
+            raise KeyError(location_name)
+
+    if to_date is None:
+        to_date = get_max_date()
+
+    layout = get_tab_layout(to_date, selected_level, location_name)
+    if RenderParams.optimize_document:
+        with span('optimize'):
+            DocumentOptimizer().optimize(layout.figure)
+
+    with span('serialize'):
+        return json.dumps(json_item(layout.figure, target=get_tab_target(selected_level, location_name)))
+
+def get_lazy_tabs(to_date, continents, active_tab = 0):
+    """ Panels where only the active tab is built, the others hold a placeholder
+        filled by the callback returned with them """
+    tabs = [(None, None, 'World Wide')] + [('continent', c, c.title()) for c in continents]
+
+    panels, urls, targets = [], [], []
+    for i, (level, location, title) in enumerate(tabs):
+        target = get_tab_target(level, location)
+        if i == active_tab:
+            child = get_tab_layout(to_date, level, location).figure
+            url = ''
+        else:
+            child = Div(text=f'<div id="{target}">Loading...</div>', width=MapParams.plot_width)
+            url = get_tab_url(level, location)
+
+        panels.append(Panel(child=child, title=title))
+        urls.append(url)
+        targets.append(target)
+
+    callback = CustomJS(args=dict(urls=urls, targets=targets), code=RenderParams.lazy_tab_js)
+    return panels, callback
+
+def get_all_tabs(to_date, continents):
+    """ The World Wide panel followed by one panel per continent """
+    world_wide = get_tab_layout(to_date)
+    continent_tabs = [Panel(child=get_tab_layout(to_date, 'continent', c).figure, title=c.title()) 
+                      for c in continents]
+    return [Panel(child=world_wide.figure, title="World Wide")] + continent_tabs
+
+def get_page_html(model, title = None):
+    """ The standalone HTML page of a layout, loading BokehJS from the CDN, with the layout centered """
+    html = file_html(model, CDN, title or RenderParams.title, template=RenderParams.page_template)
+    return html.replace('<div class="bk-root"', '<div class="bk-root" align="center"', 1)
+
+def write_page(file_name, html):
+    """ Write the page and its pre-compressed copies, each one replaced in a single step
+        so a concurrent reader never sees a half-written file """
+    body = html.encode('utf-8')
+    compressed = {file_name: body, file_name + '.gz': gzip_compress(body)}
+    if brotli is not None:
+        compressed[file_name + '.br'] = brotli.compress(body)
+
+    for path, data in compressed.items():
+        def write(temp_path):
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+        write_atomically(path, write)
+
+def gzip_compress(data):
+    """ gzip with a fixed timestamp, the same page always gives the same bytes """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+def render_dashboard(active_tab=0, file_name = 'template/dash_board.html', 
+                     optimize = None, report_size = False, lazy_tabs = None):
+    """ Render the dashboard, write it to file_name and return its HTML.
+        The spans of the render are kept in instrumentation.last_collections['render'] """
+    with collect('render'), span('render'):
+        if lazy_tabs is None:
+            lazy_tabs = RenderParams.lazy_tabs
+
+        to_date = get_max_date()
+        cont = get_all_continent(to_date)
+
+        if lazy_tabs:
+            all_tabs, lazy_tab_callback = get_lazy_tabs(to_date, cont, active_tab)
+            dash_board = Tabs(tabs=all_tabs, active=active_tab)
+            dash_board.js_on_change('active', lazy_tab_callback)
+        else:
+            dash_board = Tabs(tabs=get_all_tabs(to_date, cont), active=active_tab)
     
-    output_file(file_name)
+        if optimize is None:
+            optimize = RenderParams.optimize_document
+        if optimize:
+            with span('optimize'):
+                optimizer = DocumentOptimizer()
+                optimizer.optimize_tabs(dash_board, report=report_size)
+            if report_size:
+                logging.getLogger(__name__).info('JSON size of every tab:\n%s', optimizer.get_report())
     
-    template = """
-    {% block postamble %}
-    <style>
-    .bk-root .bk-tab {
-    font-style: normal;
-    font-size: medium;
-    }
-
-
-    .bk-root .bk-tabs-header .bk-tab.bk-active{
-    background-color: #2F4F4F;
-    color: white;
-    font-style: normal;
-    font-weight: bold;
-    font-size: medium;
-    }
-
-    </style>
-    {% endblock %}
-    """    
-
-    save(dash_board, template=template)
+        with span('html'):
+            html = get_page_html(dash_board, RenderParams.title)
+        if file_name is not None:
+            with span('write'):
+                write_page(file_name, html)
     
-    update_html_element('Corona Board', file_name)
+        return html
@@ -0,0 +1,209 @@
+""" Named timing spans of the dashboard stages.
+
+    with instrumentation.collect('render') as collector:
+        with instrumentation.span('expand'):
+            ...
+    print(collector.get_report())
+
+A span records its wall-clock and CPU time, and the peak traced memory when the
+collector was started with trace_memory=True (tracemalloc, Python 3.9+ for
+per-span peaks). tracemalloc is process-wide: one collector traces at a time,
+the others started meanwhile record no memory, and the peaks also count what
+other threads allocate, so they are only exact with one request at a time.
+Spans go to the innermost collector of the current thread and are also passed
+to every listener, outside of any collector too.
+"""
+from collections import OrderedDict
+import contextlib
+import cProfile
+import os
+import re
+import threading
+import time
+import tracemalloc
+
+
+local = threading.local()
+
+# Functions called with every finished span, e.g. to update metrics
+listeners = []
+
+# collection name -> the last finished collector of that name
+last_collections = {}
+
+# Held by the collector tracing memory, tracemalloc.reset_peak and stop act on the whole process
+memory_lock = threading.Lock()
+
+
+class Span:
+    def __init__(self, name, labels=None, parent=None):
+        self.name = name
+        # e.g. {'tab': 'Asia'}, not part of the span name so the stages stay comparable
+        self.labels = labels or {}
+        self.parent = parent
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_memory = None
+
+        self.start_memory = None
+        self.max_memory = None
+
+
+class SpanCollector:
+    """ The spans of one render or one request """
+    def __init__(self, name=None, trace_memory=False):
+        self.name = name
+        self.trace_memory = trace_memory and hasattr(tracemalloc, 'reset_peak')
+        self.spans = []
+        self.stack = []
+        self.started_tracing = False
+        self.holds_memory_lock = False
+
+    def start(self):
+        if self.trace_memory:
+            # Another collector is tracing: resetting its peaks would make both wrong
+            self.holds_memory_lock = self.trace_memory = memory_lock.acquire(blocking=False)
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        if self.holds_memory_lock:
+            self.holds_memory_lock = False
+            memory_lock.release()
+
+    def enter(self, span):
+        span.parent = self.stack[-1] if self.stack else None
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            # The parent keeps the peak reached before this span resets it
+            if span.parent is not None:
+                span.parent.max_memory = max(span.parent.max_memory, peak)
+            tracemalloc.reset_peak()
+            span.start_memory = span.max_memory = current
+        self.stack.append(span)
+
+    def exit(self, span):
+        self.stack.pop()
+        if self.trace_memory:
+            span.max_memory = max(span.max_memory, tracemalloc.get_traced_memory()[1])
+            span.peak_memory = span.max_memory - span.start_memory
+            if span.parent is not None:
+                span.parent.max_memory = max(span.parent.max_memory, span.max_memory)
+        self.spans.append(span)
+
+    def extend(self, collector):
+        self.spans.extend(collector.spans)
+
+    def get_totals(self):
+        """ name -> (count, wall time, cpu time, peak memory) over the spans of that name """
+        totals = OrderedDict()
+        for span in self.spans:
+            count, wall_time, cpu_time, peak_memory = totals.get(span.name, (0, 0.0, 0.0, None))
+            if span.peak_memory is not None:
+                peak_memory = max(peak_memory or 0, span.peak_memory)
+            totals[span.name] = (count + 1, wall_time + span.wall_time, cpu_time + span.cpu_time, peak_memory)
+        return totals
+
+    def get_server_timing(self):
+        """ The Server-Timing header value, one metric per span name with its total duration in ms """
+        metrics = []
+        for name, (count, wall_time, cpu_time, peak_memory) in self.get_totals().items():
+            desc = f'cpu {cpu_time * 1000:.1f}ms'
+            if peak_memory is not None:
+                desc += f', peak {peak_memory / 2 ** 20:.1f}MiB'
+            if count > 1:
+                desc += f', x{count}'
+            metrics.append(f'{re.sub(r"[^A-Za-z0-9_.-]+", "-", name)};dur={wall_time * 1000:.1f};desc="{desc}"')
+        return ', '.join(metrics)
+
+    def get_report(self):
+        lines = ['span | count | wall (ms) | cpu (ms) | peak memory (MiB)']
+        for name, (count, wall_time, cpu_time, peak_memory) in self.get_totals().items():
+            peak = '' if peak_memory is None else f'{peak_memory / 2 ** 20:.1f}'
+            lines.append(f'{name} | {count} | {wall_time * 1000:.1f} | {cpu_time * 1000:.1f} | {peak}')
+        return '\n'.join(lines)
+
+
+def get_collectors():
+    if not hasattr(local, 'collectors'):
+        local.collectors = []
+    return local.collectors
+
+
+def get_collector():
+    """ The innermost collector of this thread, None outside of collect() """
+    collectors = get_collectors()
+    return collectors[-1] if collectors else None
+
+
+def begin(name=None, trace_memory=False):
+    """ Start collecting the spans of this thread, end() with the returned collector stops it """
+    collector = SpanCollector(name, trace_memory)
+    collector.start()
+    get_collectors().append(collector)
+    return collector
+
+
+def end(collector):
+    collectors = get_collectors()
+    if collector in collectors:
+        collectors.remove(collector)
+    collector.stop()
+
+    # A nested collection also belongs to the enclosing one, e.g. a render within a request
+    parent = get_collector()
+    if parent is not None:
+        parent.extend(collector)
+    if collector.name is not None:
+        last_collections[collector.name] = collector
+
+
+@contextlib.contextmanager
+def collect(name=None, trace_memory=False):
+    collector = begin(name, trace_memory)
+    try:
+        yield collector
+    finally:
+        end(collector)
+
+
+@contextlib.contextmanager
+def span(name, **labels):
+    """ Time the block as a span of the current collector """
+    collector = get_collector()
+    current = Span(name, labels)
+    if collector is not None:
+        collector.enter(current)
+
+    start_wall, start_cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield current
+    finally:
+        current.wall_time = time.perf_counter() - start_wall
+        current.cpu_time = time.thread_time() - start_cpu
+        if collector is not None:
+            collector.exit(current)
+        for listener in listeners:
+            listener(current)
+
+
+class Profiler:
+    """ cProfile of one request, dumped to <profile_dir>/<time>-<name>.prof """
+    def __init__(self, profile_dir, name):
+        self.profile_dir = profile_dir
+        self.name = re.sub(r'\W+', '-', name).strip('-') or 'root'
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        file_name = os.path.join(self.profile_dir, f'{time.strftime("%Y%m%d-%H%M%S")}-{self.name}-{id(self):x}.prof')
+        self.profile.dump_stats(file_name)
+        return file_name
@@ -0,0 +1,164 @@
+""" Histograms and counters in the Prometheus text exposition format, without a client library.
+
+    requests = registry.register(Histogram('corona_board_request_seconds', 'Request latency', ['route']))
+    requests.observe(0.12, route='/')
+    registry.render()
+
+The values live in this process only, with several server worker processes
+every worker reports its own.
+"""
+import threading
+
+import instrumentation
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RENDER_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BYTES_BUCKETS = tuple(2 ** 10 * 4 ** i for i in range(9))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+
+
+class Metric:
+    """ A named metric with one value per combination of label values """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get_key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} has the labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def get_labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+    def get_samples(self):
+        """ (sample name, labels, value) of every value """
+        raise NotImplementedError
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def get_samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+
+        samples = []
+        for key, (counts, total) in values:
+            labels = self.get_labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', dict(labels, le=format_value(float(bound))), cumulative))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, cumulative))
+        return samples
+
+
+class CallbackMetric(Metric):
+    """ A metric whose values are read when scraped, get_values() returns (labels, value) pairs.
+        Used for the statistics the caches already keep """
+    def __init__(self, name, documentation, metric_type, get_values):
+        # A counter sample ends with _total, HELP and TYPE must name it the same in format 0.0.4
+        if metric_type == 'counter' and not name.endswith('_total'):
+            name += '_total'
+        super().__init__(name, documentation)
+        self.type = metric_type
+        self.get_values = get_values
+
+    def get_samples(self):
+        return [(self.name, labels, value) for labels, value in self.get_values()]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            if any(m.name == metric.name for m in self.metrics):
+                raise ValueError(f'{metric.name} is already registered')
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Every metric in the Prometheus text format """
+        with self.lock:
+            metrics = list(self.metrics)
+
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.get_samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+
+request_seconds = registry.register(Histogram(
+    'corona_board_request_seconds', 'Time to answer a request, by route, method and status',
+    ['route', 'method', 'status']))
+render_seconds = registry.register(Histogram(
+    'corona_board_render_seconds', 'Time to render the whole dashboard page', buckets=RENDER_BUCKETS))
+tab_render_seconds = registry.register(Histogram(
+    'corona_board_tab_render_seconds', 'Time to build the layout of one tab', ['tab'], buckets=RENDER_BUCKETS))
+output_bytes = registry.register(Histogram(
+    'corona_board_output_bytes', 'Size of the rendered pages and tab items', ['output'], buckets=BYTES_BUCKETS))
+data_load_seconds = registry.register(Histogram(
+    'corona_board_data_load_seconds', 'Time to load the dataset and build its indexes, one per load',
+    buckets=RENDER_BUCKETS))
+
+# Span name -> function of the span that records it
+span_metrics = {
+    'render': lambda span: render_seconds.observe(span.wall_time),
+    'tab layout': lambda span: tab_render_seconds.observe(span.wall_time, **span.labels),
+    'data load': lambda span: data_load_seconds.observe(span.wall_time),
+}
+
+
+def observe_span(span):
+    record = span_metrics.get(span.name)
+    if record is not None:
+        record(span)
+
+instrumentation.listeners.append(observe_span)
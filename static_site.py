@@ -0,0 +1,184 @@
+""" Static build of the dashboard, one page per date and location.
+
+Renders the World Wide page and the profile of every country, region and
+continent for every date of the report:
+
+    site/<to_date>/index.html
+    site/<to_date>/<level>/<location>.html
+
+site/manifest.json records the input hash and the content hash of every page.
+A page is only rendered again when its input hash changed, i.e. when the data
+up to its date or RENDER_VERSION changed, so a nightly build only renders the
+new day. Build it with:
+
+    python static_site.py --output-dir site --workers 8
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import os
+
+import bokeh
+import pandas as pd
+
+from data_cache import write_atomically
+from data_preprocessing import data_context, AggregateCube
+from data_visualization import get_tab_layout, get_page_html, get_location_slugs, DocumentOptimizer, RenderParams
+
+
+# Bump whenever the layouts change, every page is rendered again
+RENDER_VERSION = 3
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def get_page_path(to_date, selected_level=None, slug=None):
+    """ The page of a location, slug is its entry of get_location_slugs """
+    if selected_level is None:
+        return f'{to_date}/index.html'
+    return f'{to_date}/{selected_level}/{slug}.html'
+
+
+def get_page_title(to_date, selected_level=None, location_name=None):
+    return '{} - {} - {}'.format(RenderParams.title, location_name or 'World Wide', to_date)
+
+
+def get_date_digests(data_process):
+    """ to_date -> hash of every data_df row up to to_date and of the other inputs.
+        The digest of a date only changes when the data of that date or an earlier one changes,
+        a page must only show data up to its date (e.g. AggregateCube.get_first_date with to_date) """
+    digest = hashlib.sha1(f'{RENDER_VERSION}:{bokeh.__version__}'.encode())
+    for df in (data_process.locations_df, data_process.risk_assessment_df, data_process.testing_laboratories_df):
+        digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    digest = digest.hexdigest()
+
+    data_df = data_process.data_df
+    row_hashes = pd.util.hash_pandas_object(data_df, index=False)
+    digests = {}
+    for date, hashes in row_hashes.groupby(data_df.date.values):
+        day_digest = hashlib.sha1(hashes.values.tobytes()).hexdigest()
+        digest = hashlib.sha1(f'{digest}:{day_digest}'.encode()).hexdigest()
+        digests[pd.Timestamp(date).date()] = digest
+    return digests
+
+
+def get_pages(levels, from_date=None, to_date=None):
+    """ (to_date, selected_level, location_name, path, input hash) of every page, ordered by date """
+    data_process, data_fltr = data_context.get()
+    level_countries = data_fltr.get_aggregate_cube().level_countries
+    level_slugs = {level: get_location_slugs(level_countries[level]) for level in levels}
+
+    pages = []
+    for date, digest in sorted(get_date_digests(data_process).items()):
+        if (from_date is not None and date < from_date) or (to_date is not None and date > to_date):
+            continue
+
+        locations = [(None, None)]
+        for level in levels:
+            locations += [(level, location) for location in sorted(level_countries[level])]
+        for level, location in locations:
+            input_hash = hashlib.sha1(f'{digest}:{level}:{location}'.encode()).hexdigest()
+            path = get_page_path(date, level, level_slugs[level][location] if level is not None else None)
+            pages.append((date, level, location, path, input_hash))
+    return pages
+
+
+def render_page(output_dir, path, to_date, selected_level=None, location_name=None):
+    """ Render and write one page to path, return its path, content hash and size """
+    layout = get_tab_layout(to_date, selected_level, location_name)
+    if RenderParams.optimize_document:
+        DocumentOptimizer().optimize(layout.figure)
+    html = get_page_html(layout.figure, get_page_title(to_date, selected_level, location_name)).encode('utf-8')
+
+    file_name = os.path.join(output_dir, path)
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+
+    def write(temp_path):
+        with open(temp_path, 'wb') as f:
+            f.write(html)
+    write_atomically(file_name, write)
+
+    return path, hashlib.sha256(html).hexdigest(), len(html)
+
+
+def read_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest.get('pages', {})
+
+
+def write_manifest(output_dir, pages):
+    manifest = {'render_version': RENDER_VERSION, 'pages': dict(sorted(pages.items()))}
+
+    def write(temp_path):
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+    write_atomically(os.path.join(output_dir, MANIFEST_NAME), write)
+
+
+def build_site(output_dir='site', levels=AggregateCube.levels, workers=None,
+               from_date=None, to_date=None, force=False):
+    """ Render the pages whose inputs changed since the last build, return (rendered, skipped) """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    os.makedirs(output_dir, exist_ok=True)
+
+    old_manifest = read_manifest(output_dir)
+    manifest = {}
+    todo = []
+    for date, level, location, path, input_hash in get_pages(levels, from_date, to_date):
+        entry = old_manifest.get(path)
+        if not force and entry is not None and entry['input_hash'] == input_hash and \
+                os.path.exists(os.path.join(output_dir, path)):
+            manifest[path] = entry
+        else:
+            todo.append((date, level, location, path, input_hash))
+
+    skipped = len(manifest)
+    # Pages of dates or locations out of this build are kept, and so are the
+    # entries of pages that fail below: their old input hash makes the next build retry them
+    for path, entry in old_manifest.items():
+        manifest.setdefault(path, entry)
+
+    def record(result, date, level, location, path, input_hash):
+        _, content_hash, size = result
+        manifest[path] = {'to_date': str(date), 'level': level, 'location': location,
+                          'input_hash': input_hash, 'content_hash': content_hash, 'bytes': size}
+
+    # The data is loaded before the pool starts, forked workers share it
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        if executor is None:
+            for date, level, location, path, input_hash in todo:
+                record(render_page(output_dir, path, date, level, location), date, level, location, path, input_hash)
+        else:
+            futures = {executor.submit(render_page, output_dir, path, date, level, location):
+                       (date, level, location, path, input_hash) for date, level, location, path, input_hash in todo}
+            for future in as_completed(futures):
+                record(future.result(), *futures[future])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        # Keep what was rendered even when a page failed, the next build resumes from there
+        write_manifest(output_dir, manifest)
+
+    return len(todo), skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the dashboard of every date and location as static pages')
+    parser.add_argument('--output-dir', default='site')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, default one per CPU')
+    parser.add_argument('--levels', nargs='+', default=AggregateCube.levels, choices=AggregateCube.levels)
+    parser.add_argument('--from-date', type=lambda d: pd.Timestamp(d).date(), default=None)
+    parser.add_argument('--to-date', type=lambda d: pd.Timestamp(d).date(), default=None)
+    parser.add_argument('--force', action='store_true', help='render every page again')
+    args = parser.parse_args()
+
+    rendered, skipped = build_site(args.output_dir, args.levels, args.workers,
+                                   args.from_date, args.to_date, args.force)
+    print(f'rendered {rendered} pages, {skipped} unchanged')
@@ -0,0 +1,166 @@
+""" Synthetic datasets in the schema of the data/*.xlsx workbooks.
+
+Generates the report, coordinates, risk assessment and testing laboratories
+of any number of countries, regions, continents and days, e.g. to benchmark
+the dashboard far beyond the six weeks of the sample report:
+
+    python synthetic_data.py --countries 400 --days 720 --output-dir synthetic/data
+
+Workbooks are written when pandas has an Excel writer (openpyxl or XlsxWriter),
+Feather files with the same columns otherwise.
+"""
+import argparse
+import importlib.util
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# The workbook names DataPreprocessing reads by default
+DATASET_FILE_NAMES = {
+    'report': 'corona_report',
+    'locations': 'coordinates',
+    'risk_assessment': 'risk_assessment',
+    'testing_laboratories': 'testing_laboratories'
+}
+
+RISK_LOCATIONS = ['globally', 'china', 'outside_of_china']
+RISK_LEVELS = ['moderate', 'high', 'very_high']
+
+
+def get_country_names(num_countries):
+    """ China comes first, the summaries always report it """
+    return ['China'] + [f'Country {i:04d}' for i in range(1, num_countries)]
+
+
+def generate_locations(num_countries, num_regions, num_continents, random_state):
+    countries = get_country_names(num_countries)
+    ids = np.arange(num_countries)
+    return pd.DataFrame({
+        'country': countries,
+        'lat': random_state.uniform(-60, 70, num_countries),
+        'long': random_state.uniform(-180, 180, num_countries),
+        'region': [f'Region {i % num_regions + 1}' for i in ids],
+        'continent': [f'Continent {i % num_continents + 1}' for i in ids]
+    })
+
+
+def generate_report(countries, dates, random_state, report_ratio=0.95):
+    """ Cumulative counts of every country from its first case on, a country misses
+        a day's report with probability 1 - report_ratio like in the real report """
+    num_countries, num_days = len(countries), len(dates)
+
+    # China reports from the first day, the others start spread over the period
+    onset = random_state.randint(0, max(1, num_days // 2), num_countries)
+    onset[0] = 0
+    days = np.arange(num_days)
+    active = days[None, :] >= onset[:, None]
+
+    new_cases = random_state.poisson(random_state.uniform(1, 50, num_countries)[:, None], (num_countries, num_days))
+    total_cases = np.cumsum(new_cases * active, axis=1)
+    total_deaths = np.floor(total_cases * random_state.uniform(0, 0.05, num_countries)[:, None])
+
+    travel = np.floor(total_cases * random_state.uniform(0, 0.4, num_countries)[:, None])
+    outside = np.floor((total_cases - travel) * random_state.uniform(0, 0.8, num_countries)[:, None])
+    investigation = total_cases - travel - outside
+
+    reported = active & (random_state.rand(num_countries, num_days) < report_ratio)
+    country_ids, day_ids = np.nonzero(reported)
+    report_df = pd.DataFrame({
+        'country': np.asarray(countries, dtype=object)[country_ids],
+        'total_cases': total_cases[country_ids, day_ids],
+        'total_cases_with_travel_history_to_china': travel[country_ids, day_ids].astype(np.int64),
+        'total_cases_with_transmission_outside_china': outside[country_ids, day_ids].astype(np.int64),
+        'total_cases_with_transmission_site_under_investigation':
+            investigation[country_ids, day_ids].astype(np.int64),
+        'total_deaths': total_deaths[country_ids, day_ids].astype(np.int64),
+        'date': dates[day_ids]
+    })
+    return report_df.sort_values(['date', 'country'], kind='mergesort').reset_index(drop=True)
+
+
+def generate_risk_assessment(dates, random_state):
+    return pd.DataFrame({
+        'location': RISK_LOCATIONS * len(dates),
+        'severe_cases': random_state.randint(0, 1000, 3 * len(dates)),
+        'risk_assesment': random_state.choice(RISK_LEVELS, 3 * len(dates)),
+        'date': np.repeat(dates, 3)
+    })
+
+
+def generate_testing_laboratories(countries, random_state):
+    countries = list(random_state.choice(countries, max(1, len(countries) // 5), replace=False))
+    return pd.DataFrame({
+        'country': countries,
+        'number_of_laboratories': random_state.randint(1, 10, len(countries))
+    })
+
+
+def generate_dataset(num_countries=80, num_regions=6, num_continents=6, num_days=44,
+                     start_date='2020-01-21', seed=0):
+    """ name -> DataFrame of every workbook DataPreprocessing reads, see DATASET_FILE_NAMES """
+    if num_countries < 1 or num_days < 1:
+        raise ValueError('at least one country and one day are needed')
+
+    random_state = np.random.RandomState(seed)
+    dates = pd.date_range(start_date, periods=num_days)
+    locations_df = generate_locations(num_countries, num_regions, num_continents, random_state)
+    countries = locations_df.country.tolist()
+
+    return {
+        'report': generate_report(countries, dates, random_state),
+        'locations': locations_df,
+        'risk_assessment': generate_risk_assessment(dates, random_state),
+        'testing_laboratories': generate_testing_laboratories(countries, random_state)
+    }
+
+
+def has_excel_writer():
+    return any(importlib.util.find_spec(module) is not None for module in ('openpyxl', 'xlsxwriter'))
+
+
+def write_dataset(dataset, output_dir, file_format=None):
+    """ Write the frames as <name>.xlsx (or .feather, .csv), return name -> file name """
+    if file_format is None:
+        file_format = 'xlsx' if has_excel_writer() else 'feather'
+    os.makedirs(output_dir, exist_ok=True)
+
+    file_names = {}
+    for name, df in dataset.items():
+        file_name = os.path.join(output_dir, f'{DATASET_FILE_NAMES[name]}.{file_format}')
+        if file_format == 'xlsx':
+            df.to_excel(file_name, index=False)
+        elif file_format == 'feather':
+            df.reset_index(drop=True).to_feather(file_name)
+        elif file_format == 'csv':
+            df.to_csv(file_name, index=False)
+        else:
+            raise ValueError(f'unknown format: {file_format}')
+        file_names[name] = file_name
+    return file_names
+
+
+def read_dataset(file_names):
+    """ The frames written by write_dataset, read back like pd.read_excel would """
+    readers = {'.xlsx': pd.read_excel, '.feather': pd.read_feather, '.csv': pd.read_csv}
+    return {name: readers[os.path.splitext(file_name)[1]](file_name) for name, file_name in file_names.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic dataset in the schema of data/*.xlsx')
+    parser.add_argument('--countries', type=int, default=80)
+    parser.add_argument('--regions', type=int, default=6)
+    parser.add_argument('--continents', type=int, default=6)
+    parser.add_argument('--days', type=int, default=44)
+    parser.add_argument('--start-date', default='2020-01-21')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output-dir', default=os.path.join('synthetic', 'data'))
+    parser.add_argument('--format', choices=['xlsx', 'feather', 'csv'], default=None,
+                        help='default xlsx when an Excel writer is installed, else feather')
+    args = parser.parse_args()
+
+    dataset = generate_dataset(args.countries, args.regions, args.continents, args.days,
+                               args.start_date, args.seed)
+    for name, file_name in write_dataset(dataset, args.output_dir, args.format).items():
+        print(f'{name}: {file_name} ({len(dataset[name])} rows)')
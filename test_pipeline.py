@@ -0,0 +1,115 @@
+""" Fast checks of the data pipeline on small synthetic datasets, run with `python -m pytest -q`.
+The benchmarks in benchmarks.py check the same properties at scale.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks import check_same_cube, check_downsampled
+from data_analysis import DataTimeAnalysis
+from data_preprocessing import DataPreprocessing, DataFiltering, AggregateCube, data_context
+from data_visualization import render_dashboard, Utilities
+import data_metrics
+import static_site
+import synthetic_data
+
+
+def get_context(num_countries=6, num_regions=3, num_continents=2, num_days=8):
+    dataset = synthetic_data.generate_dataset(num_countries=num_countries, num_regions=num_regions,
+                                              num_continents=num_continents, num_days=num_days)
+    data_process = DataPreprocessing.from_frames(dataset['report'], dataset['locations'],
+                                                 dataset['risk_assessment'], dataset['testing_laboratories'])
+    data_fltr = DataFiltering(data_process.data_df, data_process.locations_df,
+                              data_process.risk_assessment_df, data_process.testing_laboratories_df)
+    return data_process, data_fltr
+
+
+def test_dashboard_parses_and_expands_once(tmp_path):
+    dataset = synthetic_data.generate_dataset(num_countries=6, num_regions=3, num_continents=2, num_days=8)
+    file_names = synthetic_data.write_dataset(dataset, str(tmp_path), 'xlsx')
+    stats = dict(DataPreprocessing.stats)
+
+    data_process = DataPreprocessing(file_names['report'], file_names['locations'], file_names['risk_assessment'],
+                                     file_names['testing_laboratories'], use_snapshot=False)
+    data_fltr = DataFiltering(data_process.data_df, data_process.locations_df,
+                              data_process.risk_assessment_df, data_process.testing_laboratories_df)
+    with data_context.using(data_process, data_fltr):
+        render_dashboard(file_name=None)
+        render_dashboard(file_name=None, lazy_tabs=True)
+
+    counts = {step: DataPreprocessing.stats[step] - stats[step] for step in stats}
+    assert counts == {'parse': 1, 'expand': 1, 'snapshot': 0}
+
+
+def test_static_site_builds_one_date_of_every_level(tmp_path):
+    data_process, data_fltr = get_context()
+    _, to_date = data_process.get_start_and_end_date()
+    with data_context.using(data_process, data_fltr):
+        rendered, skipped = static_site.build_site(str(tmp_path), AggregateCube.levels, workers=1,
+                                                   from_date=to_date, to_date=to_date)
+        level_countries = data_fltr.get_aggregate_cube().level_countries
+        num_pages = 1 + sum(len(level_countries[level]) for level in AggregateCube.levels)
+        assert (rendered, skipped) == (num_pages, 0)
+        assert static_site.build_site(str(tmp_path), AggregateCube.levels, workers=1,
+                                      from_date=to_date, to_date=to_date) == (0, num_pages)
+
+    pages = static_site.read_manifest(str(tmp_path))
+    assert len(pages) == num_pages
+    for path in pages:
+        assert os.path.getsize(os.path.join(str(tmp_path), path)) > 0
+
+
+@pytest.mark.parametrize('new_country', [None, 'Newland'])
+def test_append_equals_rebuild(new_country):
+    dataset = synthetic_data.generate_dataset(num_countries=6, num_regions=3, num_continents=2, num_days=8)
+    report_df = dataset['report']
+    last_date = report_df.date.max()
+    if new_country is not None:
+        report_df.loc[(report_df.date == last_date) & (report_df.country == report_df.country.iloc[-1]),
+                      'country'] = new_country
+    frames = dataset['locations'], dataset['risk_assessment'], dataset['testing_laboratories']
+
+    data_process = DataPreprocessing.from_frames(report_df[report_df.date < last_date], *frames)
+    data_fltr = DataFiltering(data_process.data_df, *frames)
+    for level in AggregateCube.levels:
+        data_fltr.get_location_positions(level, data_process.data_df[level].iloc[0])
+    data_fltr.get_aggregate_cube()
+    start = len(data_process.data_df)
+
+    new_rows = data_process.append_data(report_df[report_df.date == last_date])
+    data_fltr.append_data(data_process.data_df, new_rows)
+    # Without new countries the rows go at the end and only they are indexed
+    assert new_rows.index.equals(pd.RangeIndex(start, len(data_process.data_df))) == (new_country is None)
+
+    expected_process = DataPreprocessing.from_frames(report_df, *frames)
+    expected = DataFiltering(expected_process.data_df, *frames)
+    pd.testing.assert_frame_equal(data_process.data_df, expected_process.data_df)
+    check_same_cube(data_fltr.get_aggregate_cube(), expected.get_aggregate_cube())
+    for level in AggregateCube.levels:
+        for location in expected_process.data_df[level].dropna().unique():
+            pd.testing.assert_frame_equal(data_fltr.get_until_date_location_stats(last_date, level, location),
+                                          expected.get_until_date_location_stats(last_date, level, location))
+
+
+@pytest.mark.parametrize('max_points', [3, 20, 100])
+def test_downsampling_keeps_the_extremes_of_every_bucket(max_points):
+    data_process, data_fltr = get_context(num_days=400)
+    _, to_date = data_process.get_start_and_end_date()
+    time_analyser = DataTimeAnalysis(data_process, data_fltr, to_date=to_date)
+    series = [
+        (time_analyser.daily_and_total_cases('d', 'daily_cases', 'total_cases'), ['total_cases', 'daily_cases']),
+        (time_analyser.fatality_rate('d', 'daily_deaths', 'daily_cases'), ['fatal_rate']),
+        (time_analyser.number_of_countries('d'), ['country'])
+    ]
+    for full_df, columns in series:
+        check_downsampled(full_df, Utilities.downsample(full_df, columns, max_points), columns, max_points)
+
+
+def test_min_max_positions_skip_nan():
+    values = np.array([np.nan, 3.0, 1.0, 7.0, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan])
+    positions = data_metrics.get_min_max_positions([values], 6)
+    # Two buckets of five rows: the first keeps its 1 and 7, the second is all NaN and keeps
+    # its first and last row
+    assert positions.tolist() == [0, 2, 3, 5, 9]